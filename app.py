@@ -1,19 +1,82 @@
-import sys
 import time
+_import_start = time.perf_counter()
 
+import io
 import os
 import re
 import json
 import sys
-import termios
-import tty
-import select
-import gc
-import requests
-from tqdm import tqdm
-from llama_cpp import Llama, llama_cpp
+import argparse
+import threading
+import contextlib
 from colorama import init, Fore, Style
-from sillytavern import extract_chara_metadata, process_character_metadata
+from sillytavern import load_card, load_lorebook, card_index, import_cards
+from history import TokenCache, ChatHistory
+from snapshots import StateRing, fingerprint
+from prompt_cache import PromptCache
+from prompt import PromptBuilder, format_llama3_user_prefix
+from prewarm import PrewarmWorker
+from compaction import Compactor
+from model_pool import ModelPool
+from metrics import TurnMetrics, MetricsLog
+from journal import SessionJournal, replay, load_checkpoint, list_journals
+from swipes import generate_swipes
+from generation import chat_stream
+from turn import stream_reply
+from tune import CACHE_TYPES, CACHE_TYPE_BYTES, cpu_topology, load_tuning, tune_model
+from render import StreamRenderer, colorize
+from interrupt import AbortSwitch, InterruptListener
+from gguf import model_index, model_info, describe, kv_cache_bytes, guess_chat_format
+# llama_cpp, requests/tqdm (download) and the server are imported on first use,
+# so importing this module (and starting the app) stays fast
+
+# (stage, seconds) pairs for the --timings startup report
+startup_timings = [("imports", time.perf_counter() - _import_start)]
+
+@contextlib.contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings.append((stage, time.perf_counter() - start))
+
+class ThreadStderr:
+    """
+    Stands in for sys.stderr: writes from `thread` go to log, everyone else's
+    (e.g. the main thread's prompts and errors) go to the real stderr as usual.
+    """
+    def __init__(self, stream, thread, log):
+        self.stream = stream
+        self.thread = thread
+        self.log = log
+
+    def write(self, text):
+        target = self.log if threading.current_thread() is self.thread else self.stream
+        return target.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+@contextlib.contextmanager
+def capture_llama_log(log):
+    """
+    Sends llama.cpp's native log, and whatever the calling thread writes to stderr,
+    to log (a file-like object). Other threads' stderr is left alone.
+    """
+    import ctypes
+    from llama_cpp import llama_cpp
+    from llama_cpp._logger import llama_log_callback
+    callback = llama_cpp.llama_log_callback(
+        lambda level, text, user_data: log.write(text.decode('utf-8', errors='replace')))
+    llama_cpp.llama_log_set(callback, ctypes.c_void_p(0))
+    stderr = sys.stderr
+    sys.stderr = ThreadStderr(stderr, threading.current_thread(), log)
+    try:
+        yield
+    finally:
+        sys.stderr = stderr
+        llama_cpp.llama_log_set(llama_log_callback, ctypes.c_void_p(0))
 
 def set_console_title(title):
     try:
@@ -22,10 +85,6 @@ def set_console_title(title):
     except Exception:
         pass
 
-init()
-# Set console title
-set_console_title("ShitChat")
-
 def get_llama_cpp_version():
     """
     Finds the llama.cpp version from the .whl file in the llama.cpp folder.
@@ -41,45 +100,99 @@ def get_llama_cpp_version():
         return None
     return None
 
-llama_cpp_version = get_llama_cpp_version()
-if llama_cpp_version:
-    print(f"\nUsing llama.cpp v{llama_cpp_version}.\n")
 base_title = "ShitChat"
 __version__ = "0.1.0"
 
-def download_model(url, file_path):
+def parse_args(argv=None):
     """
-    Downloads a file from a URL and displays a progress bar.
+    Parses the command line options.
     """
-    try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()  # Raise an exception for bad status codes
-        total_size = int(response.headers.get('content-length', 0))
-        
-        with open(file_path, 'wb') as f, tqdm(
-            desc=os.path.basename(file_path),
-            total=total_size,
-            unit='iB',
-            unit_scale=True,
-            unit_divisor=1024,
-        ) as bar:
-            for chunk in response.iter_content(chunk_size=8192):
-                size = f.write(chunk)
-                bar.update(size)
-        print(f"\nModel downloaded successfully to {file_path}")
-        return True
-    except requests.exceptions.RequestException as e:
-        print(f"\nError downloading model: {e}")
-        # Clean up partially downloaded file
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        return False
-    except KeyboardInterrupt:
-        print("\nDownload cancelled by user.")
-        # Clean up partially downloaded file
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        return False
+    parser = argparse.ArgumentParser(description="ShitChat - local AI chat powered by llama.cpp")
+    parser.add_argument("--prompt-cache", action="store_true",
+                        help="cache evaluated character card prompts on disk so reopening a card is instant")
+    parser.add_argument("--prompt-cache-dir", default="cache",
+                        help="directory for the prompt cache (default: cache)")
+    parser.add_argument("--prompt-cache-size", type=float, default=8.0,
+                        help="maximum size of the prompt cache in GB (default: 8)")
+    parser.add_argument("--prewarm", action="store_true",
+                        help="evaluate the known conversation prefix in the background while you type")
+    parser.add_argument("--compact", action="store_true",
+                        help="summarize older turns while you type once the context fills up, instead of dropping them")
+    parser.add_argument("--compact-threshold", type=float, default=0.8,
+                        help="fraction of the context left after the system prompt and summary that the "
+                             "turns may fill before compaction (default: 0.8)")
+    parser.add_argument("--download-segments", type=int, default=1,
+                        help="parallel connections for downloading the default model (default: 1)")
+    parser.add_argument("--model", help="path of the .gguf model to load instead of asking")
+    parser.add_argument("--n-ctx", type=int, help="context window size to use instead of asking")
+    parser.add_argument("--serve", action="store_true",
+                        help="serve an OpenAI-compatible API instead of the interactive chat")
+    parser.add_argument("--host", default="127.0.0.1", help="address to serve on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000, help="port to serve on (default: 8000)")
+    parser.add_argument("--user", default="User", help="user name for {{user}} in cards when serving")
+    parser.add_argument("--snapshot-ram", type=float, default=4.0,
+                        help="GB of RAM for the KV snapshots /r and /g rewind to (default: 4)")
+    parser.add_argument("--session-ram", type=float, default=2.0,
+                        help="GB of RAM for parked session KV states when serving (default: 2)")
+    parser.add_argument("--session-swap-dir",
+                        help="directory to spill least recently used session KV states to when serving")
+    parser.add_argument("--model-pool", type=int, default=1,
+                        help="number of models to keep loaded for instant switching with /m (default: 1)")
+    parser.add_argument("--model-pool-ram", type=float,
+                        help="GB of memory the pooled models (weights and KV caches) may use in total")
+    parser.add_argument("--draft", metavar="lookup|MODEL",
+                        help="speculative decoding: 'lookup' drafts from n-grams in the conversation, "
+                             "or give a small .gguf draft model with the same vocabulary")
+    parser.add_argument("--draft-tokens", type=int, default=10,
+                        help="tokens drafted per step for speculative decoding (default: 10)")
+    parser.add_argument("--cpu", action="store_true", help="run on the CPU only (no GPU offload)")
+    parser.add_argument("--threads", type=int, help="threads for generation (default: llama.cpp's choice)")
+    parser.add_argument("--threads-batch", type=int, help="threads for prompt processing")
+    parser.add_argument("--autotune", action="store_true",
+                        help="calibrate thread counts and batch sizes per model and host (cached in models/.tune.json)")
+    parser.add_argument("--cache-type-k", choices=sorted(CACHE_TYPES), default="f16",
+                        help="KV cache type for keys, e.g. q8_0 to halve its memory (default: f16)")
+    parser.add_argument("--cache-type-v", choices=sorted(CACHE_TYPES), default="f16",
+                        help="KV cache type for values; quantized types turn on flash attention (default: f16)")
+    parser.add_argument("--flash-attn", action="store_true", help="use flash attention")
+    parser.add_argument("--mlock", action="store_true", help="lock the model in RAM so it is never swapped out")
+    parser.add_argument("--swipes", type=int, default=3,
+                        help="number of alternative replies /w generates in one batch (default: 3)")
+    parser.add_argument("--journal-dir", default="sessions",
+                        help="folder for session journals that /load resumes (default: sessions)")
+    parser.add_argument("--no-journal", action="store_true", help="don't record sessions")
+    parser.add_argument("--checkpoint-every", type=int, default=4,
+                        help="save the model's KV state with the journal every N replies, 0 to disable (default: 4)")
+    parser.add_argument("--metrics-log", metavar="FILE",
+                        help="append per-turn performance metrics to this JSONL file")
+    parser.add_argument("--fake-model", action="store_true",
+                        help="use a deterministic fake model backend (for testing the server)")
+    parser.add_argument("--timings", action="store_true",
+                        help="print a breakdown of startup time once the model is ready")
+    parser.add_argument("--batch", metavar="SCRIPT",
+                        help="run the user turns in SCRIPT (one per line) against every card without a terminal, then exit")
+    parser.add_argument("--batch-cards", default="cards", help="folder of cards for --batch (default: cards)")
+    parser.add_argument("--batch-output", default="batch.jsonl",
+                        help="JSONL file for --batch transcripts and timings (default: batch.jsonl)")
+    parser.add_argument("--batch-workers", type=int,
+                        help="processes for --batch, each with its own context (default: 1, or cores / 4 with --cpu)")
+    parser.add_argument("--batch-max-tokens", type=int, default=512,
+                        help="longest reply per turn in --batch (default: 512)")
+    parser.add_argument("--import-cards", metavar="DIR",
+                        help="copy the character cards in DIR into the cards folder and exit")
+    return parser.parse_args(argv)
+
+# Set up by main()
+args = None
+llm = None
+model_loader = None
+abort_switch = None
+prompt_builder = None
+prompt_cache = None
+prewarm = None
+compactor = None
+model_pool = None
+metrics_log = None
 
 def choose_model():
     """
@@ -99,7 +212,8 @@ def choose_model():
         default_model_name = "L3-8B-Stheno-v3.2-Q4_K_M.gguf"
         model_path = os.path.join(model_dir, default_model_name)
         
-        if not download_model(default_model_url, model_path):
+        from download import download_model
+        if not download_model(default_model_url, model_path, args.download_segments):
             print("Failed to download the default model. Please check your internet connection or download a model manually.")
             return None
         
@@ -113,10 +227,13 @@ def choose_model():
     if len(models) == 1:
         return os.path.join(model_dir, models[0])
         
+    index = model_index(model_dir)
     print("Please choose a model:")
     print()
     for i, model in enumerate(models):
-        print(f"{i + 1}: {model}")
+        entry = index.get(model)
+        details = f" ({describe(entry)})" if entry else ""
+        print(f"{i + 1}: {model}{details}")
         
     while True:
         try:
@@ -133,49 +250,241 @@ def choose_model():
         except ValueError:
             print("Invalid input.")
 
-def get_n_ctx():
+def kv_bytes_per_value():
+    """Average size of a K and a V cache value with the chosen cache types."""
+    return (CACHE_TYPE_BYTES[args.cache_type_k] + CACHE_TYPE_BYTES[args.cache_type_v]) / 2
+
+def get_n_ctx(info=None):
     """
     Prompts the user to enter the context window size.
+    The default is 8192, or less if the model was trained on a shorter context.
     """
+    info = info or {}
+    trained_ctx = info.get("context_length")
+    default_ctx = min(8192, trained_ctx) if trained_ctx else 8192
+    kv_bytes = kv_cache_bytes(info, default_ctx, kv_bytes_per_value())
+    if kv_bytes:
+        print(f"KV cache for {default_ctx} tokens: {kv_bytes / 1024 ** 3:.2f} GB")
     while True:
         try:
             #print()
-            n_ctx_input = input("Enter context window size (n_ctx), press Enter for default (8192): ")
+            n_ctx_input = input(f"Enter context window size (n_ctx), press Enter for default ({default_ctx}): ")
             if not n_ctx_input:
-                return 8192
+                return default_ctx
             n_ctx = int(n_ctx_input)
             if n_ctx > 0:
+                if trained_ctx and n_ctx > trained_ctx:
+                    print(f"Note: this model was trained on {trained_ctx} tokens; quality may drop beyond that.")
                 return n_ctx
             else:
                 print("Invalid input. Please enter a positive integer.")
         except ValueError:
             print("Invalid input. Please enter a valid integer.")
 
-def load_model():
+def choose_model_settings(model_path=None, n_ctx=None):
     """
-    Lets the user choose a model and context size, then loads the model.
+    Lets the user choose a model and context size (unless given).
+    Returns (model_path, n_ctx, info), or None if there is no model.
     """
-    model_path = choose_model()
+    model_path = model_path or choose_model()
     if not model_path:
         return None
     
-    n_ctx = get_n_ctx()
-    
-    return Llama(
-        model_path=model_path,
-        n_ctx=n_ctx,
-        n_gpu_layers=-1,
-        verbose=True,
-        chat_format="llama-3",
+    # Load settings come from the file's header rather than fixed guesses
+    with timed("model header"):
+        info = model_info(model_path)
+    n_ctx = n_ctx or get_n_ctx(info)
+    return model_path, n_ctx, info
+
+def open_model(model_path, n_ctx, info, log=None, report=None):
+    """
+    Loads a model with the app's settings. Notes for the user (the autotune result,
+    a draft model fallback) go through report, by default printed.
+    """
+    report = report or print
+    with timed("import llama_cpp"):
+        from llama_cpp import Llama
+    # llama.cpp's log (and llama-cpp-python's verbose output from this thread) goes to
+    # `log` if given, rather than over the user's prompts
+    with capture_llama_log(log) if log is not None else contextlib.nullcontext():
+        n_gpu_layers = 0 if args.cpu else -1
+        draft_model = None
+        if args.draft:
+            # Speculative decoding: the draft proposes tokens that the model checks in one batch
+            # It makes Llama keep every token's logits (logits_all); snapshots.save_state drops them
+            with timed("draft model load"):
+                from speculative import make_draft_model
+                draft_model = make_draft_model(args.draft, n_ctx, args.draft_tokens, n_gpu_layers=n_gpu_layers)
+        tuning = (load_tuning(model_path, n_gpu_layers) if args.autotune else None) or {}
+
+        def batch_sizes(tuning):
+            return min(tuning.get("n_batch", 512), n_ctx), min(tuning.get("n_ubatch", 512), n_ctx)
+
+        def load(tuning):
+            n_batch, n_ubatch = batch_sizes(tuning)
+            return Llama(
+                model_path=model_path,
+                n_ctx=n_ctx,
+                n_batch=n_batch,
+                n_ubatch=n_ubatch,
+                n_gpu_layers=n_gpu_layers,
+                n_threads=args.threads or tuning.get("n_threads"),
+                n_threads_batch=args.threads_batch or tuning.get("n_threads_batch"),
+                type_k=CACHE_TYPES[args.cache_type_k],
+                type_v=CACHE_TYPES[args.cache_type_v],
+                # llama.cpp needs flash attention for a quantized V cache
+                flash_attn=args.flash_attn or args.cache_type_v not in ("f16", "f32"),
+                use_mlock=args.mlock,
+                numa=len(cpu_topology()[2]) > 1,
+                verbose=True,
+                chat_format=guess_chat_format(info),
+                draft_model=draft_model,
+            )
+
+        with timed("model load"):
+            model = load(tuning)
+        if args.autotune and not (args.threads or args.threads_batch):
+            with timed("autotune"):
+                tuned = tune_model(model, model_path, n_gpu_layers, report)
+            if batch_sizes(tuned) != batch_sizes(tuning):
+                # Batch sizes are fixed when the context is created; the weights are still in the page cache
+                with timed("model reload"):
+                    model.close()
+                    model = load(tuned)
+        inner = getattr(draft_model, "draft_model", None)
+        if hasattr(inner, "n_vocab") and inner.n_vocab() != model.n_vocab():
+            report("The draft model's vocabulary doesn't match the model's; using prompt lookup instead.")
+            from speculative import make_draft_model
+            model.draft_model = make_draft_model("lookup", n_ctx, args.draft_tokens)
+        return model
+
+def load_model(model_path=None, n_ctx=None):
+    """
+    Lets the user choose a model and context size (unless given), then takes the
+    model from the pool, loading it if it isn't resident.
+    Returns (llm, reused), or (None, False) if there is no model.
+    """
+    settings = choose_model_settings(model_path, n_ctx)
+    if not settings:
+        return None, False
+    return model_pool.get(*settings)
+
+class ModelLoader:
+    """
+    Loads a model on a background thread so the user can enter their name and pick
+    a card meanwhile. llama.cpp's load log is captured instead of being printed over
+    the prompts, and notes such as the autotune result are shown once it's ready.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.model = None
+        self.error = None
+        self.log = io.StringIO()
+        self.notes = []  # Messages for the user, shown once the model is ready
+        self.thread = threading.Thread(target=self._load, daemon=True)
+        self.thread.start()
+
+    def _load(self):
+        try:
+            self.model = open_model(*self.settings, log=self.log, report=self.notes.append)
+        except Exception as e:
+            self.error = e
+
+    def done(self):
+        return not self.thread.is_alive()
+
+    def result(self):
+        self.thread.join()
+        if self.error:
+            sys.stderr.write(self.log.getvalue())
+            raise self.error
+        return self.model
+
+def model_ready():
+    """
+    Waits for the background model load (if any) and finishes setting up the model.
+    """
+    global llm, model_loader
+    if model_loader is None:
+        return
+    if not model_loader.done():
+        print("Waiting for the model to finish loading...")
+    with timed("waited for model"):
+        llm = model_loader.result()
+    for note in model_loader.notes:
+        print(note)
+    model_pool.add(*model_loader.settings, llm)
+    model_loader = None
+    setup_model()
+    if args.timings:
+        report_timings()
+
+def setup_model():
+    """
+    Applies the app's settings to a freshly loaded model.
+    """
+    # Set initial verbose setting (performance counters disabled by default)
+    global prompt_builder
+    llm.verbose = False
+    if not args.fake_model:
+        abort_switch.install(llm)
+    # llama-3 prompts are built from cached token segments instead of templating the whole chat
+    prompt_builder = PromptBuilder(llm) if llm.chat_format == "llama-3" else None
+
+def start_stream(messages):
+    """
+    Starts streaming a reply to messages. Raises ValueError if they don't fit the context.
+    """
+    # Any callable works as llama-cpp-python stopping criteria
+    if prompt_builder:
+        return chat_stream(llm, prompt_builder, messages, stopping_criteria=abort_switch.stopping_criteria)
+    return llm.create_chat_completion(
+        messages=messages,
+        stream=True,
+        stopping_criteria=abort_switch.stopping_criteria,
     )
 
-# Initialize the Llama model
-llm = load_model()
-if not llm:
-    sys.exit()
+def report_timings():
+    print()
+    print("Startup timings:")
+    for stage, seconds in startup_timings:
+        print(f"  {stage:<20} {seconds * 1000:9.1f} ms")
+    print("  (run with 'python -X importtime app.py' for a per-module import breakdown)")
+    print()
 
-# Set initial verbose setting (performance counters disabled by default)
-llm.verbose = False
+# Cap on terminal frames (and console title updates) per second while streaming
+RENDER_FPS = 30
+
+def choose_session(user_name):
+    """
+    Prompts the user to choose one of their saved sessions. Returns its journal file.
+    """
+    journals = list_journals(args.journal_dir, user_name)
+    if not journals:
+        print("\nNo saved sessions found.")
+        return None
+
+    print("\nPlease choose a session to resume:")
+    print()
+    for i, (path, header) in enumerate(journals):
+        card = os.path.basename(header["card"]) if header.get("card") else "Chat without a card"
+        saved = time.strftime("%Y-%m-%d %H:%M", time.localtime(os.path.getmtime(path)))
+        print(f"{i + 1}: {card} (last saved {saved})")
+
+    while True:
+        try:
+            print()
+            choice_input = input("Enter the number of the session you want to resume (press Enter for 1): ")
+            if not choice_input.strip():
+                choice = 1
+            else:
+                choice = int(choice_input)
+            if 1 <= choice <= len(journals):
+                return journals[choice - 1][0]
+            else:
+                print("Invalid choice.")
+        except ValueError:
+            print("Invalid input.")
 
 def choose_character():
     """
@@ -186,7 +495,8 @@ def choose_character():
         print("No 'cards' folder found.")
         return None
 
-    cards = [f for f in os.listdir(card_dir) if f.endswith(".png")]
+    index = card_index(card_dir)
+    cards = list(index)
     if not cards:
         print("No character cards found in the 'cards' folder.")
         return None
@@ -194,7 +504,12 @@ def choose_character():
     print("Please choose a character card:")
     print()
     for i, card in enumerate(cards):
-        print(f"{i + 1}: {card}")
+        entry = index[card]
+        if "error" in entry:
+            details = " (no character data)"
+        else:
+            details = f" - {entry['description']}" if entry.get("description") else ""
+        print(f"{i + 1}: {card}{details}")
         
     while True:
         try:
@@ -211,64 +526,21 @@ def choose_character():
         except ValueError:
             print("Invalid input.")
 
-def truncate_context(messages, max_tokens):
+def count_tokens(text):
     """
-    Truncates the context to fit within the model's context window.
-    Keeps the system message and recent conversation history.
+    Returns the number of tokens in text, falling back to a rough estimate.
     """
-    if len(messages) <= 2:  # System + user message
-        return messages
-    
-    # Always keep the system message
-    system_message = messages[0]
-    other_messages = messages[1:]
-    
-    # Calculate precise token count
-    def count_tokens(text):
-        if not text:
-            return 0
-        try:
-            return len(llm.tokenize(text.encode('utf-8', errors='ignore'), add_bos=False))
-        except Exception:
-            return len(text) // 4
-
-    # Calculate system message tokens
-    system_tokens = count_tokens(system_message.get("content", ""))
-    available_tokens = max_tokens - system_tokens - 100  # Leave some buffer
-    
-    # Keep recent messages that fit
-    truncated_messages = [system_message]
-    current_tokens = 0
-    
-    # Start from the most recent messages and work backwards
-    for message in reversed(other_messages):
-        message_tokens = count_tokens(message.get("content", ""))
-        if current_tokens + message_tokens <= available_tokens:
-            truncated_messages.insert(1, message)
-            current_tokens += message_tokens
-        else:
-            break
-    
-    return truncated_messages
-
-
-class NonBlockingRaw:
-    """A context manager to enter raw terminal mode."""
-    def __enter__(self):
-        self.old_settings = termios.tcgetattr(sys.stdin)
-        tty.setcbreak(sys.stdin.fileno())
-        return self
+    if not text:
+        return 0
+    try:
+        return len(llm.tokenize(text.encode('utf-8', errors='ignore'), add_bos=False))
+    except Exception:
+        return len(text) // 4
 
-    def __exit__(self, type, value, traceback):
-        termios.tcsetattr(sys.stdin, termios.TCSADRAIN, self.old_settings)
+token_cache = TokenCache(count_tokens)
 
-def check_interrupt():
-    """
-    Cross-platform function to check if interrupt was requested.
-    Returns True if a key was pressed, False otherwise.
-    """
-    # Check if there's data available on stdin
-    return select.select([sys.stdin], [], [], 0) == ([sys.stdin], [], [])
+# KV state snapshots taken after each prompt eval, used by rewind and regenerate
+state_ring = None  # Set up by main()
 
 
 def chat():
@@ -282,8 +554,12 @@ def chat():
         "'/i' - View character card details\n"
         "'/s' - Load a Sillytavern character card from cards folder (or drag drop)\n"
         "'/r' - Rewind chat one step\n"
+        "'/g' - Regenerate last AI reply\n"
+        "'/w [n]' - Generate n alternative AI replies at once and pick one\n"
         "'/m' - Load a new model and/or context size\n"
+        "'/load' - Resume a saved session\n"
         "'/p' - Toggle detailed performance counters in AI reply\n"
+        "'/stats' - Show per-turn performance statistics\n"
         "'enter' - Force AI to continue\n"
         "'any key' - Interrupt AI response\n"
     )
@@ -353,27 +629,77 @@ def chat():
     
     setup_screen()
     print(f"\nWelcome, {user_name}!")
-    messages = []
+    history = ChatHistory(token_cache)
     first_prompt = True
     current_character = None
+    lorebook = None  # Keyword index of the current card's character_book
+    prompt_cache_key = None  # Set while a freshly loaded card's prompt still needs caching
+    journal = None  # SessionJournal recording the current conversation
+    replies_since_checkpoint = 0
+    snapshot_warned = False  # Told the user once that snapshots don't fit --snapshot-ram
+
+    def start_journal(card_path):
+        """Starts journaling the current conversation as a new session."""
+        nonlocal journal, replies_since_checkpoint
+        close_journal()
+        if args.no_journal:
+            return
+        journal = SessionJournal.create(args.journal_dir, user_name, card_path, llm.model_path, history.messages)
+        history.journal = journal
+        replies_since_checkpoint = 0
+
+    def close_journal():
+        nonlocal journal
+        if journal:
+            history.journal = None
+            journal.close()
+            journal = None
+
+    def prompt_budget():
+        return llm.n_ctx() - 500 # Leave a buffer
+
+    def prompt_window():
+        """Returns the part of the history that is sent to the model."""
+        return history.window(prompt_budget())
+
+    def restore_snapshot(messages):
+        """Restores the KV state saved after these messages were evaluated, if any."""
+        state = state_ring.get(fingerprint(messages))
+        if state is not None:
+            llm.load_state(state)
+
+    def restore_cached_prompt():
+        """Loads the card's evaluated prompt from the disk cache, or marks it to be cached."""
+        nonlocal prompt_cache_key
+        prompt_cache_key = None
+        if not prompt_cache:
+            return
+        key = prompt_cache.key(llm.model_path, llm.n_ctx(), history[0]["content"])
+        state = prompt_cache.load(key)
+        if state is not None:
+            llm.load_state(state)
+        else:
+            prompt_cache_key = key
+
+    def reprint_history():
+        """Reprints the conversation in one write."""
+        parts = []
+        for msg in history:
+            if msg['role'] == 'user':
+                parts.append(f"\n{Fore.GREEN}You: {Style.RESET_ALL}{msg['content']}\n")
+            elif msg['role'] == 'assistant':
+                parts.append(f"\n{Fore.CYAN}AI: {Style.RESET_ALL}{colorize(msg['content'])}\n")
+        sys.stdout.write("".join(parts))
+        sys.stdout.flush()
     
     def load_character(card_path, user_name):
-        chara_json = extract_chara_metadata(card_path)
-        if not chara_json:
-            print("No 'chara' metadata found in PNG.")
-            return None, None
-
-        chara_obj, talk_prompt, depth_prompt = process_character_metadata(chara_json, user_name)
+        chara_obj, system_prompt = load_card(card_path, user_name)
         if not chara_obj:
-            print("Failed to process character metadata.")
             return None, None
 
         setup_screen()
         print(f"\nSillyTavern PNG Character Card Loaded. Waiting for AI Response...")
 
-        data_section = chara_obj.get('data', chara_obj)
-        modified_data_json_string = json.dumps(data_section)
-        system_prompt = f"{talk_prompt}{depth_prompt}roleplay the following scene defined in the json. do not break from your character\\n{modified_data_json_string}"
         messages = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": ""}
@@ -385,35 +711,89 @@ def chat():
         # Add a blank line for spacing after AI response (only if performance counters disabled)
         if not show_perf_counters:
             print()
+        prewarm_text = None
+        if prewarm and llm is not None and len(history) and llm.chat_format == "llama-3":
+            # Evaluate everything up to the next user message while waiting for input
+            prewarm_text = format_llama3_user_prefix(prompt_window())
+        # Summarize old turns while waiting for input if the context is filling up (after prewarming)
+        compacting = compactor is not None and llm is not None and compactor.start(
+            llm, history, prompt_budget(), prewarm_text)
+        if not compacting and prewarm_text:
+            prewarm.start(llm, prewarm_text)
         user_input = input(f"{Fore.GREEN}You: {Style.RESET_ALL}").strip().strip('"')
+        if compacting:
+            compactor.stop()
+            compactor.apply(history)
+        if prewarm:
+            prewarm.stop()
+        # Let the model keep loading while the user picks a card
+        if user_input.lower() != '/s':
+            model_ready()
         
         should_continue = False
+        regenerate = False
 
         # Handle PNG drag and drop
         if user_input.lower().endswith(".png") and os.path.exists(user_input):
             new_messages, new_character = load_character(user_input, user_name)
             if new_messages:
-                messages = new_messages
+                history.reset(new_messages)
+                restore_cached_prompt()
                 current_character = new_character
+                lorebook = load_lorebook(new_character)
+                start_journal(user_input)
                 should_continue = True
         
         elif user_input.lower() == '/c':
-            messages = []
+            # The cleared session stays in its journal and can be resumed with /load
+            close_journal()
+            history.clear()
+            lorebook = None
             setup_screen()
             print(f"\nWelcome, {user_name}!")
             continue
 
         elif user_input.lower() == '/s':
             card_path = choose_character()
+            model_ready()
             if card_path:
                 new_messages, new_character = load_character(card_path, user_name)
                 if new_messages:
-                    messages = new_messages
+                    history.reset(new_messages)
+                    restore_cached_prompt()
                     current_character = new_character
+                    lorebook = load_lorebook(new_character)
+                    start_journal(card_path)
                     should_continue = True
             if not should_continue:
                 continue
 
+        elif user_input.lower() == '/load':
+            journal_file = choose_session(user_name)
+            if not journal_file:
+                continue
+            session = replay(journal_file)
+            close_journal()
+            current_character = None
+            if session["card"] and os.path.exists(session["card"]):
+                current_character, _ = load_card(session["card"], user_name)
+            lorebook = load_lorebook(current_character) if current_character else None
+            history.reset(session["messages"])
+            history.pinned = session["pinned"]
+            if session["model"] != os.path.abspath(llm.model_path):
+                # Saved token counts are from another model's tokenizer
+                history.recount()
+            # The checkpoint holds the evaluated conversation, so nothing needs re-processing
+            restored = load_checkpoint(journal_file, session["checkpoint"], llm)
+            state_ring.clear()
+            journal = SessionJournal(journal_file)
+            history.journal = journal
+            replies_since_checkpoint = 0
+            setup_screen()
+            print(f"\nSession resumed{' from its checkpoint' if restored else ''}.")
+            reprint_history()
+            continue
+
         elif user_input.lower() == '/i':
             if current_character:
                 print(json.dumps(current_character, indent=2))
@@ -423,20 +803,18 @@ def chat():
 
         elif user_input.lower() == '/m':
             print("\nLoading new model...")
-            
-            # Free the backend and unload the old model
-            llama_cpp.llama_backend_free()
-            del llm
-            gc.collect()
 
-            # Re-initialize the backend
-            llama_cpp.llama_backend_init()
-
-            new_llm = load_model()
+            # The pool unloads the least recently used model if the new one doesn't fit
+            new_llm, reused = load_model()
             if new_llm:
-                llm = new_llm
+                if new_llm is not llm:
+                    llm = new_llm
+                    setup_model()
+                    # Cached token counts and KV snapshots belong to the old model
+                    history.recount()
+                    state_ring.clear()
                 llm.verbose = show_perf_counters  # Apply current performance counter setting
-                print("New model loaded successfully.")
+                print("Switched to the already loaded model." if reused else "New model loaded successfully.")
                 setup_screen()
             else:
                 print("Failed to load new model. The application will now exit.")
@@ -444,36 +822,88 @@ def chat():
             continue
 
         elif user_input.lower() == '/r':
-            if len(messages) >= 2:
-                messages = messages[:-2]
+            if len(history) >= 2:
+                # The snapshot of the rewound turn's prompt already holds the kept history
+                history.pop(1)
+                restore_snapshot(prompt_window())
+                history.pop(1)
+                # Lore injected for the rewound message goes with it
+                while len(history) > 1 and history[-1].get("lore"):
+                    history.pop(1)
                 setup_screen()
                 print("\nRewound one step.")
                 # Reprint the conversation history
-                for i, msg in enumerate(messages):
-                    if msg['role'] == 'system':
-                        continue
-                    
-                    if msg['role'] == 'user':
-                        print(f"\n{Fore.GREEN}You: {Style.RESET_ALL}{msg['content']}")
-                    elif msg['role'] == 'assistant':
-                        print(f"\n{Fore.CYAN}AI: {Style.RESET_ALL}", end="")
-                        content = msg['content']
-                        in_yellow_block = False
-                        for char in content:
-                            if char == '*':
-                                in_yellow_block = not in_yellow_block
-                                print(f"{Fore.YELLOW}{char}{Style.RESET_ALL}", end="")
-                            else:
-                                if in_yellow_block:
-                                    print(f"{Fore.YELLOW}{char}{Style.RESET_ALL}", end="")
-                                else:
-                                    print(char, end="")
-                        print() # ensure newline after message
+                reprint_history()
 
             else:
                 print(f"\nNot enough history to rewind.")
             continue
 
+        elif user_input.lower() == '/g':
+            if len(history) >= 2 and history[-1]['role'] == 'assistant':
+                # Drop the last reply and go back to the KV state from before it was generated
+                history.pop(1)
+                restore_snapshot(prompt_window())
+                setup_screen()
+                print("\nRegenerating last reply.")
+                reprint_history()
+                regenerate = True
+            else:
+                print("\nNo AI reply to regenerate.")
+                continue
+
+        elif user_input.lower().split()[0:1] == ['/w']:
+            if len(history) < 2 or history[-1]['role'] != 'assistant':
+                print("\nNo AI reply to swipe.")
+                continue
+            if llm.chat_format != "llama-3":
+                # Swipe prompts are built in the llama-3 format
+                print("\n/w needs a model with the llama-3 chat format.")
+                continue
+            parts = user_input.split()
+            try:
+                n = int(parts[1]) if len(parts) > 1 else args.swipes
+            except ValueError:
+                print("\nUsage: /w [number of replies]")
+                continue
+            n = max(2, min(n, 8))
+            original = history[-1]
+            history.pop(1)
+            # Start from the KV state of the reply's prompt so all of it is shared
+            messages = prompt_window()
+            restore_snapshot(messages)
+            print(f"\nGenerating {n} alternative replies (press any key to stop)...")
+            with InterruptListener(abort_switch):
+                candidates = generate_swipes(llm, messages, n, cancel=abort_switch.event, builder=prompt_builder)
+            candidates = [c for c in candidates if c]
+            if not candidates:
+                print("No replies were generated.")
+                history.append(original)
+                continue
+            print(f"\n0: {Fore.CYAN}(keep){Style.RESET_ALL} {colorize(original['content'])}")
+            for i, candidate in enumerate(candidates):
+                print(f"\n{i + 1}: {colorize(candidate)}")
+            while True:
+                print()
+                choice_input = input("Pick a reply (press Enter for 1): ").strip()
+                try:
+                    choice = int(choice_input) if choice_input else 1
+                except ValueError:
+                    print("Invalid input.")
+                    continue
+                if 0 <= choice <= len(candidates):
+                    break
+                print("Invalid choice.")
+            history.append(original if choice == 0 else {"role": "assistant", "content": candidates[choice - 1]})
+            setup_screen()
+            reprint_history()
+            continue
+
+        elif user_input.lower() == '/stats':
+            print()
+            print(metrics_log.summary())
+            continue
+
         elif user_input.lower() == '/p':
             show_perf_counters = not show_perf_counters
             llm.verbose = show_perf_counters
@@ -487,10 +917,12 @@ def chat():
                 print("• total time = Total processing time")
                 print("• graphs reused = Number of computation graphs reused for efficiency")
                 print("• prefix-match hit = Number of tokens matched from previous context")
+                if getattr(llm, "draft_model", None) is not None:
+                    print("• speculative decoding = Drafted tokens the model accepted (higher is faster)")
                 print()
             continue
 
-        if should_continue or not user_input.strip():
+        if not regenerate and (should_continue or not user_input.strip()):
             # Overwrite the "You: " prompt line from input()
             print(f"\x1b[1A\x1b[2K{Fore.GREEN}You: {Style.RESET_ALL}continue")
             user_input = "continue"
@@ -502,29 +934,37 @@ def chat():
             llm.verbose = False
             first_prompt = False
         
+        metrics = TurnMetrics(llm)
+        truncation_start = time.perf_counter()
         # Only append user message if it's not a PNG file path
-        if not (user_input.lower().endswith(".png") and os.path.exists(user_input)):
-            messages.append({"role": "user", "content": user_input})
+        if not regenerate and not (user_input.lower().endswith(".png") and os.path.exists(user_input)):
+            if journal is None:
+                # A chat without a card gets its journal with the first message
+                start_journal(None)
+            if lorebook:
+                # Lorebook entries triggered by this turn go in just before it
+                lore = lorebook.lore_message(prompt_window(), user_input, token_cache.count)
+                if lore:
+                    history.append(lore)
+            history.append({"role": "user", "content": user_input})
         
-        # Truncate context if it's getting too long
-        messages = truncate_context(messages, llm.n_ctx() - 500) # Leave a buffer
+        # Only send the most recent history that fits the context window
+        messages = prompt_window()
+        metrics.truncation += time.perf_counter() - truncation_start
+        draft_stats = getattr(llm, "draft_model", None)
+        if draft_stats is not None:
+            draft_stats.reset()
         
-        start_time = time.time()
+        metrics.begin_generation()
         try:
-            stream = llm.create_chat_completion(
-                messages=messages,
-                stream=True,
-            )
+            stream = start_stream(messages)
         except ValueError as e:
             if "exceed context window" in str(e):
                 print(f"{Fore.RED}Context window exceeded. Truncating conversation history...{Style.RESET_ALL}")
                 # More aggressive truncation
-                messages = truncate_context(messages, llm.n_ctx() // 2)
+                messages = history.window(llm.n_ctx() // 2)
                 try:
-                    stream = llm.create_chat_completion(
-                        messages=messages,
-                        stream=True,
-                    )
+                    stream = start_stream(messages)
                 except ValueError as e2:
                     print(f"{Fore.RED}Error: {e2}{Style.RESET_ALL}")
                     print(f"{Fore.YELLOW}Please use '/clear' to reset the conversation.{Style.RESET_ALL}")
@@ -533,74 +973,122 @@ def chat():
                 print(f"{Fore.RED}Error: {e}{Style.RESET_ALL}")
                 continue
         
-        assistant_response = ""
-        token_count = 0
-        in_yellow_block = False
+        renderer = StreamRenderer(max_fps=RENDER_FPS)
         print(f"{Fore.CYAN}AI: {Style.RESET_ALL}", end="")
         sys.stdout.flush()
 
-        if llm:
-            base_total_tokens = sum(len(llm.tokenize(m.get("content", "").encode('utf-8', errors='ignore'), add_bos=False)) for m in messages)
+        save_prompt_state = None
+        if prompt_cache_key:
+            cache_key = prompt_cache_key
+            # Write the card's prompt state to disk without holding up generation
+            save_prompt_state = lambda state: threading.Thread(target=prompt_cache.save, args=(cache_key, state)).start()
+
+        # Any key pressed while generating (or evaluating the prompt) interrupts the AI
+        assistant_message, turn, rejected_snapshot = stream_reply(
+            llm, stream, messages, history, metrics, renderer, state_ring, token_cache,
+            listener=InterruptListener(abort_switch), cancel=abort_switch.event,
+            save_prompt_state=save_prompt_state, draft_stats=draft_stats)
+        if turn["interrupted"]:
+            print(f"\n{Fore.YELLOW}[Interrupted]{Style.RESET_ALL}")
         else:
-            base_total_tokens = sum(len(m.get("content", "")) // 4 for m in messages)
-            
-        max_tokens = llm.n_ctx()
-        
-        was_interrupted = False
-        # Use a context manager to handle terminal mode safely
-        with NonBlockingRaw():
-            for output in stream:
-                if check_interrupt():
-                    # Consume the character from the buffer to prevent it from affecting the next input()
-                    sys.stdin.read(1)   # Consume on Linux
-                    
-                    print(f"\n{Fore.YELLOW}[Interrupted]{Style.RESET_ALL}")
-                    was_interrupted = True
-                    break
-                text = output["choices"][0]["delta"].get("content")
-                if text:
-                    assistant_response += text
-                    token_count += 1
-                    for char in text:
-                        if char == '*':
-                            in_yellow_block = not in_yellow_block
-                        else:
-                            if in_yellow_block:
-                                print(f"{Fore.YELLOW}{char}{Style.RESET_ALL}", end="")
-                            else:
-                                print(char, end="")
-                    sys.stdout.flush()
-                    
-                    # Real-time stats update for console title
-                    duration = time.time() - start_time
-                    tokens_per_second = token_count / duration if duration > 0 else 0
-                    
-                    # Calculate current total tokens accurately
-                    current_response_tokens = len(llm.tokenize(assistant_response.encode('utf-8', errors='ignore'), add_bos=False))
-                    total_tokens = base_total_tokens + current_response_tokens
-                    context_percent = (total_tokens / max_tokens) * 100 if max_tokens > 0 else 0
-                    
-                    # Update console title
-                    set_console_title(f"tps: {tokens_per_second:.2f} - ctx: {context_percent:.2f}%")
-        
-        if not was_interrupted:
             print()
+        if show_perf_counters and draft_stats is not None:
+            print(draft_stats.summary())
+        if rejected_snapshot and not snapshot_warned:
+            snapshot_warned = True
+            print(f"{Fore.YELLOW}This prompt's KV snapshot ({rejected_snapshot / 1024 ** 3:.2f} GB) is larger than "
+                  f"--snapshot-ram, so /r and /g will process the prompt again.{Style.RESET_ALL}")
+        # Only the first prompt after loading a card is worth caching
+        prompt_cache_key = None
+        metrics_log.add(turn)
+
+        if journal:
+            replies_since_checkpoint += 1
+            if args.checkpoint_every and replies_since_checkpoint >= args.checkpoint_every:
+                journal.checkpoint(llm, len(history))
+                replies_since_checkpoint = 0
         
-        messages.append({"role": "assistant", "content": assistant_response})
-        
-        
-        # Final update after loop finishes
-        end_time = time.time()
-        duration = end_time - start_time
-        tokens_per_second = token_count / duration if duration > 0 else 0
-        
-        # Recalculate context usage accurately
-        total_tokens = sum(len(llm.tokenize(m.get("content", "").encode('utf-8', errors='ignore'), add_bos=False)) for m in messages)
-        context_percent = (total_tokens / max_tokens) * 100 if max_tokens > 0 else 0
-        
-        # Update console title
-        set_console_title(f"tps: {tokens_per_second:.2f} - ctx: {context_percent:.2f}%")
-        
+
+def run_batch_mode():
+    """
+    Runs --batch: the model settings come from the command line instead of prompts.
+    """
+    if not args.model and not args.fake_model:
+        print("--batch needs --model.")
+        return
+    info = model_info(args.model) if args.model else {}
+    n_ctx = args.n_ctx or min(8192, info.get("context_length") or 8192)
+    physical_cores = cpu_topology()[0]
+    workers = args.batch_workers or (max(1, physical_cores // 4) if args.cpu else 1)
+    if not args.threads:
+        # Split the cores between the workers rather than oversubscribing them
+        args.threads = max(1, physical_cores // workers)
+    from batch import run_batch
+    run_batch(args, (args.model, n_ctx, info), workers)
+
+def main(argv=None):
+    """
+    Parses the command line, starts loading the model and runs the chat (or the server).
+    """
+    global args, llm, model_loader, abort_switch, prompt_cache, prewarm, compactor, model_pool, metrics_log
+    global state_ring
+    args = parse_args(argv)
+
+    if args.import_cards:
+        imported, skipped = import_cards(args.import_cards)
+        print(f"Imported {len(imported)} character cards into 'cards'.")
+        for name in skipped:
+            print(f"Skipped {name}: no character data.")
+        return
+
+    if args.batch:
+        run_batch_mode()
+        return
+
+    init()
+    # Set console title
+    set_console_title("ShitChat")
+
+    llama_cpp_version = get_llama_cpp_version()
+    if llama_cpp_version:
+        print(f"\nUsing llama.cpp v{llama_cpp_version}.\n")
+
+    # Pressing a key flips this switch, which stops generation and prompt processing
+    abort_switch = AbortSwitch()
+    if args.prompt_cache:
+        prompt_cache = PromptCache(args.prompt_cache_dir, int(args.prompt_cache_size * 1024 ** 3))
+    prewarm = PrewarmWorker() if args.prewarm else None
+    state_ring = StateRing(max_states=8, max_bytes=int(args.snapshot_ram * 1024 ** 3))
+    compactor = Compactor(threshold=args.compact_threshold) if args.compact else None
+    metrics_log = MetricsLog(args.metrics_log)
+    model_pool = ModelPool(open_model, args.model_pool,
+                           int(args.model_pool_ram * 1024 ** 3) if args.model_pool_ram else None,
+                           kv_bytes_per_value())
+
+    # Initialize the Llama model
+    if args.fake_model:
+        from fakellm import FakeLlama
+        llm = FakeLlama(n_ctx=args.n_ctx or 8192, tokens_per_second=20)
+        setup_model()
+    else:
+        settings = choose_model_settings(args.model, args.n_ctx)
+        if not settings:
+            sys.exit()
+        if args.serve:
+            llm = open_model(*settings)
+            setup_model()
+        else:
+            # The chat asks for the user's name while the model loads
+            model_loader = ModelLoader(settings)
+
+    if args.serve:
+        if args.timings:
+            report_timings()
+        from server import serve
+        serve(llm, token_cache, args.host, args.port, user_name=args.user,
+              max_resident_bytes=int(args.session_ram * 1024 ** 3), swap_dir=args.session_swap_dir)
+    else:
+        chat()
 
 if __name__ == "__main__":
-    chat()
+    main()
@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from history import TokenCache, ChatHistory
+from metrics import TurnMetrics
+from prompt import PromptBuilder
+from generation import chat_stream
+from sillytavern import load_card, load_lorebook, card_index
+
+# Set up in each worker process by init_worker()
+worker = None
+
+
+def load_script(path):
+    """
+    Reads the user turns of a batch script: one message per line, an empty line
+    to let the AI continue (like pressing Enter in the chat), # for comments.
+    """
+    with open(path, encoding='utf-8') as f:
+        return [line.rstrip("\n") for line in f if not line.startswith("#")]
+
+
+class BatchWorker:
+    """
+    One model in one process, running scripted sessions through the chat's steps:
+    card load, lore injection, windowing and generation.
+    """
+    def __init__(self, llm, user_name, max_tokens):
+        self.llm = llm
+        self.user_name = user_name
+        self.max_tokens = max_tokens
+        self.builder = PromptBuilder(llm) if llm.chat_format == "llama-3" else None
+        self.token_cache = TokenCache(
+            lambda text: len(llm.tokenize(text.encode('utf-8', errors='ignore'), add_bos=False)))
+
+    def reply(self, messages, metrics):
+        metrics.begin_generation()
+        if self.builder:
+            stream = chat_stream(self.llm, self.builder, messages)
+        else:
+            stream = self.llm.create_chat_completion(messages=messages, stream=True)
+        parts = []
+        for output in stream:
+            text = output["choices"][0]["delta"].get("content")
+            if not text:
+                continue
+            if metrics.first_token is None:
+                metrics.on_first_token()
+            parts.append(text)
+            if metrics.tokens_so_far() >= self.max_tokens:
+                break
+        stream.close()
+        return "".join(parts)
+
+    def run(self, card_path, script):
+        """
+        Plays script against a card and returns its transcript with per-turn metrics.
+        """
+        start = time.perf_counter()
+        record = {"card": os.path.basename(card_path), "model": os.path.basename(self.llm.model_path),
+                  "n_ctx": self.llm.n_ctx(), "pid": os.getpid(), "turns": []}
+        chara_obj, system_prompt = load_card(card_path, self.user_name)
+        if not chara_obj:
+            record["error"] = "no character data"
+            return record
+        lorebook = load_lorebook(chara_obj)
+        history = ChatHistory(self.token_cache, [{"role": "system", "content": system_prompt},
+                                                 {"role": "user", "content": ""}])
+        budget = self.llm.n_ctx() - 500
+        # Each card starts from an empty cache, as after loading it in the chat
+        self.llm.n_tokens = 0
+        # The first turn is the card's greeting, like loading a card in the chat
+        for text in [""] + script:
+            text = text.strip() or "continue"
+            metrics = TurnMetrics(self.llm)
+            truncation_start = time.perf_counter()
+            if lorebook:
+                lore = lorebook.lore_message(history.window(budget), text, self.token_cache.count)
+                if lore:
+                    history.append(lore)
+            history.append({"role": "user", "content": text})
+            messages = history.window(budget)
+            metrics.truncation += time.perf_counter() - truncation_start
+            try:
+                reply = self.reply(messages, metrics)
+            except ValueError as e:
+                record["error"] = str(e)
+                break
+            history.append({"role": "assistant", "content": reply})
+            turn = metrics.record()
+            # Per card rather than per turn, and nothing is rendered or interrupted here
+            for key in ("model", "n_ctx", "render_ms", "interrupted"):
+                del turn[key]
+            record["turns"].append({"user": text, "reply": reply, **turn})
+        record["seconds"] = time.perf_counter() - start
+        return record
+
+
+def init_worker(app_args, settings):
+    """
+    Loads the model in a pool process. The weights are memory mapped, so every
+    worker shares the same pages of the file.
+    """
+    global worker
+    import app
+    app.args = app_args
+    if app_args.fake_model:
+        from fakellm import FakeLlama
+        llm = FakeLlama(n_ctx=settings[1])
+    else:
+        llm = app.open_model(*settings)
+        llm.verbose = False
+    worker = BatchWorker(llm, app_args.user, app_args.batch_max_tokens)
+
+
+def run_card(card_path, script):
+    return worker.run(card_path, script)
+
+
+def run_batch(app_args, settings, workers):
+    """
+    Runs the batch script against every card in app_args.batch_cards on a pool
+    of workers, writing one JSON line per card to app_args.batch_output.
+    """
+    script = load_script(app_args.batch)
+    card_dir = app_args.batch_cards
+    cards = [os.path.join(card_dir, name) for name, entry in card_index(card_dir).items() if "error" not in entry]
+    if not cards:
+        print(f"No character cards found in '{card_dir}'.")
+        return
+    print(f"Running {len(script) + 1} turns against {len(cards)} cards on {workers} workers.", file=sys.stderr)
+    start = time.perf_counter()
+    with open(app_args.batch_output, 'w', encoding='utf-8') as out, \
+            ProcessPoolExecutor(workers, initializer=init_worker, initargs=(app_args, settings)) as pool:
+        futures = {pool.submit(run_card, card, script): card for card in cards}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                record = future.result()
+            except Exception as e:
+                record = {"card": os.path.basename(futures[future]), "error": f"{type(e).__name__}: {e}"}
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            status = record.get("error") or f"{len(record['turns'])} turns in {record['seconds']:.1f} s"
+            print(f"[{done}/{len(cards)}] {record['card']}: {status}", file=sys.stderr)
+    print(f"Wrote {app_args.batch_output} in {time.perf_counter() - start:.1f} s.", file=sys.stderr)
@@ -0,0 +1,223 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import contextlib
+from collections import defaultdict
+
+from history import TokenCache, ChatHistory
+from fakellm import FakeLlama
+from render import StreamRenderer
+from prompt import PromptBuilder
+from generation import chat_stream
+from metrics import TurnMetrics
+from turn import stream_reply
+from snapshots import StateRing
+from sillytavern import extract_chara_metadata, load_card, load_lorebook, card_index
+
+RENDER_FPS = 30  # Same frame cap as the chat loop in app.py
+
+# Rough stand-in for a BPE tokenizer: cost grows with the length of the text
+TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+def fake_count_tokens(text):
+    return len(TOKEN_RE.findall(text))
+
+def make_message(role, turn):
+    text = f"*{role} turn {turn}* " + " ".join(f"word{i}" for i in range(60))
+    return {"role": role, "content": text}
+
+def legacy_truncate_context(messages, max_tokens):
+    """
+    The original truncate_context(): re-tokenizes everything and inserts at the front.
+    """
+    if len(messages) <= 2:
+        return messages
+    system_message = messages[0]
+    available_tokens = max_tokens - fake_count_tokens(system_message["content"]) - 100
+    truncated_messages = [system_message]
+    current_tokens = 0
+    for message in reversed(messages[1:]):
+        tokens = fake_count_tokens(message["content"])
+        if current_tokens + tokens <= available_tokens:
+            truncated_messages.insert(1, message)
+            current_tokens += tokens
+        else:
+            break
+    return truncated_messages
+
+def bench_truncation(turns, max_tokens, repeat=20):
+    """
+    Returns the average per-turn cost in microseconds of the legacy truncation
+    and of ChatHistory.window() for a history of the given number of turns.
+    """
+    system = {"role": "system", "content": "scene " * 2000}
+    messages = [system]
+    for turn in range(turns):
+        messages.append(make_message("user", turn))
+        messages.append(make_message("assistant", turn))
+
+    # The legacy path gets the whole history every turn (a card with no truncation yet)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        legacy_truncate_context(messages, max_tokens)
+    legacy = (time.perf_counter() - start) / repeat * 1e6
+
+    history = ChatHistory(TokenCache(fake_count_tokens), messages)
+    start = time.perf_counter()
+    for turn in range(repeat):
+        # A realistic turn: append the user message, window, append the reply
+        history.append(make_message("user", turns + turn))
+        history.window(max_tokens)
+        history.append(make_message("assistant", turns + turn))
+    windowed = (time.perf_counter() - start) / repeat * 1e6
+    return legacy, windowed
+
+def print_truncation_table():
+    max_tokens = 8192 - 500
+    print(f"{'turns':>8} {'legacy us/turn':>16} {'window us/turn':>16}")
+    for turns in (10, 100, 500, 2000):
+        legacy, windowed = bench_truncation(turns, max_tokens)
+        print(f"{turns:>8} {legacy:>16.1f} {windowed:>16.1f}")
+
+class StageTimer:
+    """Collects wall clock samples per pipeline stage."""
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def add(self, stage, seconds):
+        self.samples[stage].append(seconds)
+
+    @contextlib.contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def report(self):
+        """
+        Returns {stage: {count, mean, p50, p90, p99, max}} with times in milliseconds.
+        """
+        report = {}
+        for stage, samples in self.samples.items():
+            ordered = sorted(samples)
+            def pick(q):
+                return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1e3, 4)
+            report[stage] = {
+                "count": len(ordered),
+                "mean": round(sum(ordered) / len(ordered) * 1e3, 4),
+                "p50": pick(0.50),
+                "p90": pick(0.90),
+                "p99": pick(0.99),
+                "max": round(ordered[-1] * 1e3, 4),
+            }
+        return report
+
+USER_LINES = (
+    "*looks around the room* What happened here, {name}?",
+    "I think we should keep moving before it gets dark.",
+    "*picks up the old map and unfolds it on the table* Where does this road lead?",
+    "Tell me more about yourself.",
+    "",  # Enter: let the AI continue
+    "*nods slowly* Alright. I trust you. Lead the way.",
+    "Did you hear that? Something is outside the door.",
+)
+
+def user_message(turn, name):
+    return USER_LINES[turn % len(USER_LINES)].format(name=name) or "continue"
+
+def run_session(llm, token_cache, builder, card_path, turns, timer, out):
+    """
+    Replays a scripted session against a card through the chat's own turn: lore
+    injection, windowing, then stream_reply() with its generation thread, KV
+    snapshot, renderer and TurnMetrics.
+    """
+    with timer("card_parse"):
+        extract_chara_metadata(card_path)
+    with timer("card_load"):
+        chara_obj, system_prompt = load_card(card_path, "Bench")
+    if not chara_obj:
+        return
+    lorebook = load_lorebook(chara_obj)
+    name = chara_obj.get("data", chara_obj).get("name") or "you"
+    history = ChatHistory(token_cache, [{"role": "system", "content": system_prompt},
+                                        {"role": "user", "content": ""}])
+    state_ring = StateRing()
+    budget = llm.n_ctx() - 500
+
+    for turn in range(turns):
+        turn_start = time.perf_counter()
+        metrics = TurnMetrics(llm)
+        text = user_message(turn, name) if turn else "continue"
+        with timer("lore"):
+            lore = lorebook.lore_message(history.window(budget), text, token_cache.count) if lorebook else None
+        if lore:
+            history.append(lore)
+        history.append({"role": "user", "content": text})
+        with timer("truncation"):
+            messages = history.window(budget)
+
+        metrics.begin_generation()
+        stream = chat_stream(llm, builder, messages)
+        renderer = StreamRenderer(max_fps=RENDER_FPS, out=out)
+        _, record, _ = stream_reply(llm, stream, messages, history, metrics, renderer, state_ring, token_cache)
+        ttft_ms = record["ttft_ms"] or 0
+        timer.add("ttft", ttft_ms / 1e3)
+        # The app's own work before the model starts on the prompt
+        timer.add("pre_generation", (ttft_ms - (record["prompt_eval_ms"] or 0)) / 1e3)
+        timer.add("render", record["render_ms"] / 1e3)
+        timer.add("turn", time.perf_counter() - turn_start)
+        out.seek(0)
+        out.truncate()
+
+def bench_sessions(card_dir="cards", turns=150, n_ctx=8192, tokens_per_second=0, reply_tokens=48):
+    """
+    Replays a scripted session against every card in card_dir with a fake model and
+    returns the latency percentiles of each pipeline stage.
+    """
+    llm = FakeLlama(n_ctx=n_ctx, tokens_per_second=tokens_per_second, reply_tokens=reply_tokens)
+    token_cache = TokenCache(lambda text: len(llm.tokenize(text.encode('utf-8', errors='ignore'), add_bos=False)))
+    builder = PromptBuilder(llm)
+    timer = StageTimer()
+    out = io.StringIO()
+    with timer("card_index"):
+        cards = [os.path.join(card_dir, name) for name, entry in card_index(card_dir).items() if "error" not in entry]
+    for card_path in cards:
+        run_session(llm, token_cache, builder, card_path, turns, timer, out)
+    return {
+        "config": {"cards": len(cards), "turns": turns, "n_ctx": n_ctx,
+                   "tokens_per_second": tokens_per_second, "reply_tokens": reply_tokens},
+        "unit": "ms",
+        "stages": timer.report(),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the chat pipeline's own overhead with a fake model")
+    parser.add_argument("--cards", default="cards", help="folder of cards to replay sessions against")
+    parser.add_argument("--turns", type=int, default=150, help="turns per card (default: 150)")
+    parser.add_argument("--n-ctx", type=int, default=8192, help="fake context size (default: 8192)")
+    parser.add_argument("--tps", type=float, default=0, help="fake tokens per second, 0 for no delay (default: 0)")
+    parser.add_argument("--reply-tokens", type=int, default=48, help="tokens per fake reply (default: 48)")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--truncation", action="store_true",
+                        help="print the legacy truncation vs ChatHistory.window table instead")
+    args = parser.parse_args(argv)
+    if args.truncation:
+        print_truncation_table()
+        return
+
+    report = bench_sessions(args.cards, args.turns, args.n_ctx, args.tps, args.reply_tokens)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import threading
+from bisect import bisect_left
+
+from history import ChatHistory
+from snapshots import fingerprint, save_state
+from prewarm import eval_prefix
+from prompt import format_llama3, format_llama3_user_prefix
+
+SUMMARY_PROMPT = (
+    "You maintain the memory of a long roleplay chat. Write a concise summary of the "
+    "story so far in the past tense: who the characters are, what happened, important "
+    "facts, promises and the current situation. Merge the previous summary, if any, "
+    "with the new conversation. Reply with the summary only."
+)
+SUMMARY_HEADER = "Summary of the story so far:\n"
+
+
+class Compactor:
+    """
+    Summarizes older turns into a rolling memory message while the user is typing,
+    once the turns use more than `threshold` of the token budget left after the
+    pinned system prompt and summary. Enough of the oldest turns are folded in to
+    leave at most `target` of it in recent turns, so compaction runs rarely and the
+    prompt prefix stays the same (and KV-reusable) between runs.
+    Summaries are cached by the turns they cover, so a repeated compaction doesn't
+    generate them again, and a cancelled one keeps the summary prompt it already
+    evaluated for the next attempt (the turns it covers only grow, so that prompt
+    is still its prefix).
+    """
+    def __init__(self, threshold=0.8, target=0.5, summary_tokens=400):
+        self.threshold = threshold
+        self.target = target
+        self.summary_tokens = summary_tokens
+        self.summaries = {}  # fingerprint of the summarized messages -> summary text
+        self.thread = None
+        self.cancel = None
+        self.result = None  # (fingerprint of messages[:end], end, summary message)
+        self.partial = None  # (model path, n_ctx, KV state of a cancelled summary prompt)
+
+    def plan(self, history, budget):
+        """
+        Returns the end of the messages[1:end] range to summarize, or None if the
+        history is still under the threshold.
+        """
+        if len(history) < 4:
+            return None
+        pinned = history.prefix[history.pinned]
+        # The pinned messages stay, so only what is left after them can be freed
+        available = budget - pinned
+        if available <= 0 or history.total_tokens - pinned <= self.threshold * available:
+            return None
+        # Smallest end that leaves at most target * available tokens after the summary
+        end = bisect_left(history.prefix, history.total_tokens - self.target * available, history.pinned + 1)
+        # Always keep the latest exchange
+        end = min(end, len(history) - 2)
+        # Folding in only lore or empty messages would just rewrite the same summary
+        if not any(m.get("content") and not m.get("lore") for m in history.messages[history.pinned:end]):
+            return None
+        return end
+
+    def start(self, llm, history, budget, prewarm_text=None):
+        """
+        Starts compacting on a background thread if the history needs it. The chat's
+        prewarm_text, if given, is evaluated first, so the next reply doesn't wait on
+        a compaction that is cut short. Returns False if there is nothing to do.
+        """
+        self.stop()
+        end = self.plan(history, budget)
+        if end is None:
+            return False
+        self.result = None
+        self.cancel = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(llm, history, budget, end, prewarm_text, self.cancel),
+                                       daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        """
+        Cancels compaction in progress and waits until the model is free again.
+        """
+        if self.thread:
+            self.cancel.set()
+            self.thread.join()
+            self.thread = None
+
+    def apply(self, history):
+        """
+        Replaces the summarized turns with the summary if compaction finished for
+        this exact history. Returns True if the history was compacted.
+        """
+        if not self.result:
+            return False
+        key, end, summary = self.result
+        self.result = None
+        if len(history) <= end or fingerprint(history.messages[:end]) != key:
+            return False
+        history.compact(end, summary)
+        return True
+
+    def summary_messages(self, messages):
+        """
+        Returns the chat messages asking the model to summarize messages (which may
+        start with the previous summary).
+        """
+        lines = []
+        for message in messages:
+            content = message.get("content", "")
+            if message.get("lore"):
+                # Lorebook entries are injected again when they come up
+                continue
+            if content.startswith(SUMMARY_HEADER):
+                lines.append(f"Previous summary:\n{content[len(SUMMARY_HEADER):]}\n")
+            elif content:
+                lines.append(f"{message['role'].capitalize()}: {content}")
+        return [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": "\n\n".join(lines)},
+        ]
+
+    def summarize(self, llm, messages, cancel):
+        """
+        Generates the summary of messages. Returns None if cancelled.
+        """
+        key = fingerprint(messages)
+        summary = self.summaries.get(key)
+        if summary is not None:
+            return summary
+        request = self.summary_messages(messages)
+        if self.partial and self.partial[:2] == (llm.model_path, llm.n_ctx()):
+            # Pick up the summary prompt where the last attempt was cancelled
+            llm.load_state(self.partial[2])
+        # Evaluate the prompt in cancellable batches first; generation then reuses it
+        if llm.chat_format == "llama-3" and not eval_prefix(llm, format_llama3(request), cancel):
+            self.partial = (llm.model_path, llm.n_ctx(), save_state(llm))
+            return None
+        parts = []
+        stream = llm.create_chat_completion(
+            messages=request,
+            stream=True,
+            max_tokens=self.summary_tokens,
+            temperature=0.3,
+            stopping_criteria=lambda input_ids, logits: cancel.is_set(),
+        )
+        for output in stream:
+            parts.append(output["choices"][0]["delta"].get("content") or "")
+        if cancel.is_set():
+            self.partial = (llm.model_path, llm.n_ctx(), save_state(llm))
+            return None
+        self.partial = None
+        summary = self.summaries[key] = "".join(parts).strip()
+        return summary
+
+    def _run(self, llm, history, budget, end, prewarm_text, cancel):
+        if prewarm_text:
+            try:
+                if not eval_prefix(llm, prewarm_text, cancel):
+                    return
+            except Exception:
+                return
+        # Summarizing replaces the chat's KV cache, so put it back if the user comes back first
+        saved = save_state(llm)
+        try:
+            summary = self.summarize(llm, history.messages[1:end], cancel)
+            if summary is None:
+                llm.load_state(saved)
+                return
+            message = {"role": "system", "content": f"{SUMMARY_HEADER}{summary}"}
+            self.result = (fingerprint(history.messages[:end]), end, message)
+            if llm.chat_format == "llama-3":
+                # Evaluate the compacted prompt so the next reply starts right away
+                compacted = ChatHistory(history.token_cache, [history[0], message] + history.messages[end:])
+                compacted.pinned = 2
+                eval_prefix(llm, format_llama3_user_prefix(compacted.window(budget)), cancel)
+        except Exception:
+            # Fall back to dropping old turns, as without compaction
+            self.result = None
+            llm.load_state(saved)
@@ -0,0 +1,236 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+
+import requests
+from tqdm import tqdm
+
+CHUNK_SIZE = 4 * 1024 * 1024
+RETRIES = 3
+
+
+def expected_sha256(url):
+    """
+    Returns the SHA-256 Hugging Face publishes for a file, or None if it isn't known.
+    For LFS files the resolve URL answers with the hash in the X-Linked-Etag header.
+    """
+    try:
+        response = requests.head(url, allow_redirects=False, timeout=30)
+    except requests.exceptions.RequestException:
+        return None
+    etag = response.headers.get("X-Linked-Etag") or response.headers.get("ETag") or ""
+    etag = etag.removeprefix("W/").strip('"').lower()
+    return etag if re.fullmatch(r"[0-9a-f]{64}", etag) else None
+
+
+def probe(url):
+    """
+    Returns (size, supports_ranges) for a URL, following redirects.
+    """
+    response = requests.head(url, allow_redirects=True, timeout=30)
+    response.raise_for_status()
+    size = int(response.headers.get("Content-Length", 0))
+    return size, response.headers.get("Accept-Ranges", "").lower() == "bytes"
+
+
+def sha256_file(path, length=None):
+    """
+    Hashes the first length bytes of a file (all of it by default), returning the hash object.
+    """
+    sha = hashlib.sha256()
+    remaining = os.path.getsize(path) if length is None else length
+    with open(path, 'rb') as f:
+        while remaining > 0:
+            data = f.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            sha.update(data)
+            remaining -= len(data)
+    return sha
+
+
+def preallocate(fd, size):
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+
+
+class SegmentedDownload:
+    """
+    Downloads a URL into a preallocated .part file using one or more HTTP Range
+    requests. Progress of each segment is kept in a .part.json file next to it,
+    so an interrupted download resumes where it stopped.
+    """
+    def __init__(self, url, part_path, size, segments):
+        self.url = url
+        self.part_path = part_path
+        self.state_path = f"{part_path}.json"
+        self.size = size
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.segments = self.load_segments(segments)
+
+    def load_segments(self, count):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            if state["url"] == self.url and state["size"] == self.size and os.path.exists(self.part_path):
+                return state["segments"]
+        except (OSError, ValueError, KeyError):
+            pass
+        # Start over: [start, end, next byte to fetch] per segment
+        step = -(-self.size // count)
+        segments = [[start, min(start + step, self.size), start] for start in range(0, self.size, step)]
+        fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            preallocate(fd, self.size)
+        finally:
+            os.close(fd)
+        return segments
+
+    def save_segments(self):
+        with self.lock:
+            state = {"url": self.url, "size": self.size, "segments": self.segments}
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.state_path)
+
+    @property
+    def done_bytes(self):
+        return sum(pos - start for start, _, pos in self.segments)
+
+    def fetch_segment(self, segment, fd, bar, sha=None):
+        """
+        Fetches the rest of one segment, retrying on connection errors. If sha is
+        given the bytes are hashed in order as they arrive.
+        """
+        for attempt in range(RETRIES + 1):
+            start, end, pos = segment
+            if pos >= end or self.stop.is_set():
+                return
+            try:
+                headers = {"Range": f"bytes={pos}-{end - 1}"}
+                with requests.get(self.url, headers=headers, stream=True, timeout=60) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise requests.exceptions.RequestException("Server ignored the range request.")
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        if self.stop.is_set():
+                            return
+                        chunk = chunk[:end - segment[2]]
+                        os.pwrite(fd, chunk, segment[2])
+                        if sha:
+                            sha.update(chunk)
+                        with self.lock:
+                            segment[2] += len(chunk)
+                        bar.update(len(chunk))
+                        self.save_segments()
+                        if segment[2] >= end:
+                            return
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError):
+                if attempt == RETRIES:
+                    raise
+
+    def run(self):
+        """
+        Downloads all unfinished segments in parallel. Returns the in-order SHA-256 of
+        the file when downloading with one segment, since it can be hashed as it streams.
+        """
+        fd = os.open(self.part_path, os.O_RDWR)
+        bar = tqdm(
+            desc=os.path.basename(self.part_path)[:-len(".part")],
+            total=self.size,
+            initial=self.done_bytes,
+            unit='iB',
+            unit_scale=True,
+            unit_divisor=1024,
+        )
+        try:
+            if len(self.segments) == 1:
+                segment = self.segments[0]
+                sha = sha256_file(self.part_path, segment[2] - segment[0])
+                self.fetch_segment(segment, fd, bar, sha)
+                return sha
+            with ThreadPoolExecutor(max_workers=len(self.segments)) as pool:
+                futures = [pool.submit(self.fetch_segment, s, fd, bar) for s in self.segments]
+                try:
+                    # Wait in short steps so Ctrl+C is noticed by the main thread
+                    while True:
+                        finished, pending = wait(futures, timeout=0.5, return_when=FIRST_EXCEPTION)
+                        for future in finished:
+                            future.result()
+                        if not pending:
+                            break
+                finally:
+                    self.stop.set()
+            return None
+        finally:
+            self.stop.set()
+            bar.close()
+            os.close(fd)
+            self.save_segments()
+
+
+def download_model(url, file_path, segments=1):
+    """
+    Downloads a file from a URL and displays a progress bar.
+    The download goes to a .part file that is resumed on the next run if it is
+    interrupted, and is checked against the published SHA-256 before being moved
+    into place.
+    """
+    part_path = f"{file_path}.part"
+    try:
+        size, supports_ranges = probe(url)
+        expected = expected_sha256(url)
+        if size and supports_ranges:
+            download = SegmentedDownload(url, part_path, size, max(1, segments))
+            if download.done_bytes:
+                print(f"Resuming download at {download.done_bytes / 1024 ** 2:.0f} MB.")
+            sha = download.run()
+            if download.done_bytes < size:
+                print("\nDownload incomplete. Run again to resume.")
+                return False
+        else:
+            # No range support: a plain single stream that can't be resumed
+            sha = hashlib.sha256()
+            with requests.get(url, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                with open(part_path, 'wb') as f, tqdm(
+                    desc=os.path.basename(file_path),
+                    total=size,
+                    unit='iB',
+                    unit_scale=True,
+                    unit_divisor=1024,
+                ) as bar:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        sha.update(chunk)
+                        bar.update(len(chunk))
+
+        if expected:
+            print("Verifying SHA-256...")
+            digest = (sha or sha256_file(part_path)).hexdigest()
+            if digest != expected:
+                print(f"\nChecksum mismatch (expected {expected}, got {digest}). Deleting the download.")
+                os.remove(part_path)
+                if os.path.exists(f"{part_path}.json"):
+                    os.remove(f"{part_path}.json")
+                return False
+        os.replace(part_path, file_path)
+        if os.path.exists(f"{part_path}.json"):
+            os.remove(f"{part_path}.json")
+        print(f"\nModel downloaded successfully to {file_path}")
+        return True
+    except requests.exceptions.RequestException as e:
+        print(f"\nError downloading model: {e}")
+        print("The partial download has been kept. Run again to resume.")
+        return False
+    except KeyboardInterrupt:
+        print("\nDownload cancelled by user. Run again to resume.")
+        return False
@@ -0,0 +1,159 @@
+import re
+import time
+import zlib
+
+
+WORDS = (
+    "the", "night", "is", "quiet", "and", "she", "looks", "at", "you", "with", "a",
+    "tired", "smile", "*leans", "closer*", "we", "should", "move", "before", "dawn",
+    "*glances", "at", "the", "door*", "did", "you", "hear", "that", "?",
+)
+TOKEN_RE = re.compile(rb"\s*\S+|\s+")
+
+
+class FakeLlamaState:
+    """A stand-in for llama_cpp.LlamaState."""
+    def __init__(self, input_ids):
+        self.input_ids = list(input_ids)
+        self.n_tokens = len(self.input_ids)
+        self.llama_state_size = self.n_tokens * 4
+
+
+class FakeLlama:
+    """
+    A deterministic stand-in for llama_cpp.Llama, so the chat pipeline and the HTTP
+    server can run without a model. Words are tokens, replies are canned text picked
+    from the last message, and tokens are produced at tokens_per_second (0 = no delay).
+    """
+    def __init__(self, n_ctx=8192, tokens_per_second=0, reply_tokens=48, model_path="fake.gguf"):
+        self._n_ctx = n_ctx
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.model_path = model_path
+        self.chat_format = "llama-3"
+        self.verbose = False
+        self.n_batch = 512
+        self.n_tokens = 0
+        self.input_ids = []
+        self.vocab = {}
+        self.pieces = {}
+
+    @property
+    def _input_ids(self):
+        return self.input_ids[:self.n_tokens]
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def token_eos(self):
+        return 2
+
+    def tokenize(self, text, add_bos=True, special=False):
+        tokens = [1] if add_bos else []
+        for piece in TOKEN_RE.findall(text):
+            token = self.vocab.get(piece)
+            if token is None:
+                token = self.vocab[piece] = 3 + len(self.vocab)
+                self.pieces[token] = piece
+            tokens.append(token)
+        return tokens
+
+    def detokenize(self, tokens, prev_tokens=None, special=False):
+        return b"".join(self.pieces.get(t, b"") for t in tokens)
+
+    def eval(self, tokens):
+        self.input_ids = self.input_ids[:self.n_tokens] + list(tokens)
+        self.n_tokens = len(self.input_ids)
+
+    def save_state(self):
+        return FakeLlamaState(self._input_ids)
+
+    def load_state(self, state):
+        self.input_ids = list(state.input_ids)
+        self.n_tokens = state.n_tokens
+
+    def reply_words(self, messages, max_tokens=None):
+        last = messages[-1].get("content", "") if messages else ""
+        start = zlib.crc32(last.encode('utf-8')) % len(WORDS)
+        count = self.reply_tokens if max_tokens is None else min(max_tokens, self.reply_tokens)
+        return [WORDS[(start + i) % len(WORDS)] for i in range(count)]
+
+    def _prompt_tokens(self, messages):
+        text = "".join(f"{m.get('role', '')}: {m.get('content', '')}\n" for m in messages)
+        tokens = self.tokenize(text.encode('utf-8'))
+        if len(tokens) > self._n_ctx:
+            raise ValueError(f"Requested tokens ({len(tokens)}) exceed context window of {self._n_ctx}")
+        return tokens
+
+    def create_chat_completion(self, messages, stream=False, max_tokens=None, stopping_criteria=None, **kwargs):
+        prompt_tokens = self._prompt_tokens(messages)
+        words = self.reply_words(messages, max_tokens)
+        if stream:
+            return self._stream(prompt_tokens, words, stopping_criteria)
+        self.eval(prompt_tokens)
+        text = " ".join(words)
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": self.model_path,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "length"}],
+            "usage": {
+                "prompt_tokens": len(prompt_tokens),
+                "completion_tokens": len(words),
+                "total_tokens": len(prompt_tokens) + len(words),
+            },
+        }
+
+    def generate(self, tokens, stopping_criteria=None, **kwargs):
+        """Yields reply tokens like Llama.generate, reusing the cached prefix."""
+        n_past = 0
+        for a, b in zip(self._input_ids, tokens):
+            if a != b:
+                break
+            n_past += 1
+        self.n_tokens = n_past
+        self.eval(tokens[n_past:])
+        start = sum(tokens) % len(WORDS)
+        delay = 1.0 / self.tokens_per_second if self.tokens_per_second else 0
+        for i in range(self.reply_tokens):
+            if delay:
+                time.sleep(delay)
+            if stopping_criteria is not None and stopping_criteria(self._input_ids, None):
+                return
+            word = WORDS[(start + i) % len(WORDS)]
+            token = self.tokenize((word if i == 0 else f" {word}").encode('utf-8'), add_bos=False)[0]
+            yield token
+            self.eval([token])
+
+    def _chunk(self, delta, finish_reason=None):
+        return {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": self.model_path,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    def _stream(self, prompt_tokens, words, stopping_criteria):
+        # Reuse the common prefix like llama.cpp, then "evaluate" the rest of the prompt
+        n_past = 0
+        for a, b in zip(self._input_ids, prompt_tokens):
+            if a != b:
+                break
+            n_past += 1
+        self.n_tokens = n_past
+        self.eval(prompt_tokens[n_past:])
+        yield self._chunk({"role": "assistant"})
+        delay = 1.0 / self.tokens_per_second if self.tokens_per_second else 0
+        finish_reason = "length"
+        for i, word in enumerate(words):
+            if delay:
+                time.sleep(delay)
+            if stopping_criteria is not None and stopping_criteria(self._input_ids, None):
+                finish_reason = "stop"
+                break
+            text = word if i == 0 else f" {word}"
+            self.eval(self.tokenize(text.encode('utf-8'), add_bos=False))
+            yield self._chunk({"content": text})
+        yield self._chunk({}, finish_reason)
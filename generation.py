@@ -0,0 +1,114 @@
+import time
+import codecs
+import queue
+import threading
+
+DONE = object()
+
+# create_chat_completion's defaults, under Llama.generate's names
+CHAT_SAMPLING = {"temp": 0.2, "top_p": 0.95, "top_k": 40, "min_p": 0.05, "repeat_penalty": 1.0}
+
+
+def chunk(delta, finish_reason=None):
+    return {"object": "chat.completion.chunk", "created": int(time.time()),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+
+def chat_stream(llm, builder, messages, stopping_criteria=None, **sampling):
+    """
+    Streams a reply to messages like create_chat_completion(stream=True), but from
+    the PromptBuilder's cached token segments through Llama.generate, without
+    rendering and tokenizing the whole conversation again.
+    Raises ValueError right away if the prompt doesn't fit the context.
+    """
+    tokens = builder.build(messages)
+    if len(tokens) > llm.n_ctx():
+        raise ValueError(f"Requested tokens ({len(tokens)}) exceed context window of {llm.n_ctx()}")
+    return _token_stream(llm, tokens, builder.stop_tokens, stopping_criteria, {**CHAT_SAMPLING, **sampling})
+
+
+def _token_stream(llm, tokens, stop_tokens, stopping_criteria, sampling):
+    # Tokens can end in the middle of a UTF-8 character
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+    yield chunk({"role": "assistant"})
+    finish_reason = "length"
+    for token in llm.generate(tokens, stopping_criteria=stopping_criteria, **sampling):
+        if token in stop_tokens:
+            finish_reason = "stop"
+            break
+        text = decoder.decode(llm.detokenize([token]))
+        if text:
+            yield chunk({"content": text})
+        # Llama.generate evaluates the token after this one is taken
+        if llm.n_tokens + 1 >= llm.n_ctx():
+            break
+    yield chunk({}, finish_reason)
+
+
+class GenerationStream:
+    """
+    Iterates a create_chat_completion stream on a producer thread and hands its text
+    to the consumer through a bounded queue, so the model never waits on the
+    terminal. The consumer takes everything produced since its last read in one
+    go, which keeps it caught up even when a frame is slow to draw.
+    on_first_text(text) runs on the producer thread before the first text is
+    queued, while the model state is exactly "prompt evaluated" (e.g. for save_state).
+    The queue only fills up if the consumer stops reading entirely.
+    """
+    def __init__(self, stream, on_first_text=None, cancel=None, maxsize=1024):
+        self.stream = stream
+        self.on_first_text = on_first_text
+        self.cancel = cancel
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.finish_reason = None
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _produce(self):
+        first = True
+        try:
+            for output in self.stream:
+                choice = output["choices"][0]
+                self.finish_reason = choice.get("finish_reason") or self.finish_reason
+                text = choice["delta"].get("content")
+                if not text:
+                    continue
+                if first and self.on_first_text:
+                    self.on_first_text(text)
+                first = False
+                self.queue.put(text)
+                if self.cancel is not None and self.cancel.is_set():
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            self.queue.put(DONE)
+
+    def batches(self):
+        """
+        Yields the text produced since the previous batch, blocking until there is
+        some. Re-raises the producer's exception once the stream is drained.
+        """
+        done = False
+        while not done:
+            parts = [self.queue.get()]
+            while True:
+                try:
+                    parts.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if parts[-1] is DONE:
+                parts.pop()
+                done = True
+            if parts:
+                yield "".join(parts)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __iter__(self):
+        return self.batches()
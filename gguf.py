@@ -0,0 +1,222 @@
+import os
+import mmap
+import json
+import struct
+
+GGUF_MAGIC = b"GGUF"
+
+# GGUF metadata value types: struct format and size of the fixed-size ones
+SCALAR_TYPES = {
+    0: ("<B", 1), 1: ("<b", 1), 2: ("<H", 2), 3: ("<h", 2), 4: ("<I", 4), 5: ("<i", 4),
+    6: ("<f", 4), 7: ("<?", 1), 10: ("<Q", 8), 11: ("<q", 8), 12: ("<d", 8),
+}
+TYPE_STRING = 8
+TYPE_ARRAY = 9
+
+# llama_ftype values stored in general.file_type
+FILE_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1",
+    10: "Q2_K", 11: "Q3_K_S", 12: "Q3_K_M", 13: "Q3_K_L", 14: "Q4_K_S", 15: "Q4_K_M",
+    16: "Q5_K_S", 17: "Q5_K_M", 18: "Q6_K", 19: "IQ2_XXS", 20: "IQ2_XS", 21: "Q2_K_S",
+    22: "IQ3_XS", 23: "IQ3_XXS", 24: "IQ1_S", 25: "IQ4_NL", 26: "IQ3_S", 27: "IQ3_M",
+    28: "IQ2_S", 29: "IQ2_M", 30: "IQ4_XS", 31: "IQ1_M", 32: "BF16", 36: "TQ1_0", 37: "TQ2_0",
+}
+
+INDEX_FILE = ".index.json"
+
+
+class GGUFReader:
+    """Walks the header of a memory-mapped GGUF file without touching the tensor data."""
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+
+    def unpack(self, fmt, size):
+        value = struct.unpack_from(fmt, self.buf, self.pos)[0]
+        self.pos += size
+        return value
+
+    def string(self):
+        length = self.unpack("<Q", 8)
+        value = bytes(self.buf[self.pos:self.pos + length])
+        self.pos += length
+        return value.decode('utf-8', errors='replace')
+
+    def skip_string(self):
+        length = self.unpack("<Q", 8)
+        self.pos += length
+
+    def value(self, value_type, keep=True):
+        """
+        Reads a metadata value. Arrays are skipped and returned as their length, since
+        tokenizer vocabularies can hold hundreds of thousands of strings.
+        """
+        if value_type in SCALAR_TYPES:
+            return self.unpack(*SCALAR_TYPES[value_type])
+        if value_type == TYPE_STRING:
+            if keep:
+                return self.string()
+            self.skip_string()
+            return None
+        if value_type == TYPE_ARRAY:
+            item_type = self.unpack("<I", 4)
+            count = self.unpack("<Q", 8)
+            if item_type in SCALAR_TYPES:
+                self.pos += SCALAR_TYPES[item_type][1] * count
+            else:
+                for _ in range(count):
+                    self.value(item_type, keep=False)
+            return count
+        raise ValueError(f"Unknown GGUF value type {value_type}")
+
+
+def read_gguf_metadata(path):
+    """
+    Returns the metadata key/values and the total parameter count of a GGUF file,
+    reading only its header through mmap.
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        if buf[:4] != GGUF_MAGIC:
+            raise ValueError(f"Not a GGUF file: {path}")
+        reader = GGUFReader(buf)
+        reader.pos = 4
+        version = reader.unpack("<I", 4)
+        count_fmt = ("<I", 4) if version == 1 else ("<Q", 8)
+        tensor_count = reader.unpack(*count_fmt)
+        kv_count = reader.unpack(*count_fmt)
+
+        metadata = {}
+        for _ in range(kv_count):
+            key = reader.string()
+            value_type = reader.unpack("<I", 4)
+            metadata[key] = reader.value(value_type)
+
+        parameters = 0
+        for _ in range(tensor_count):
+            reader.skip_string()
+            n_dims = reader.unpack("<I", 4)
+            elements = 1
+            for _ in range(n_dims):
+                elements *= reader.unpack("<Q", 8)
+            reader.pos += 4 + 8  # tensor type, data offset
+            parameters += elements
+        return metadata, parameters
+
+
+def read_gguf_info(path):
+    """
+    Returns the properties of a model file that matter for loading it.
+    """
+    metadata, parameters = read_gguf_metadata(path)
+    arch = metadata.get("general.architecture", "")
+    head_count = metadata.get(f"{arch}.attention.head_count")
+    file_type = metadata.get("general.file_type")
+    return {
+        "name": metadata.get("general.name"),
+        "architecture": arch,
+        "context_length": metadata.get(f"{arch}.context_length"),
+        "block_count": metadata.get(f"{arch}.block_count"),
+        "embedding_length": metadata.get(f"{arch}.embedding_length"),
+        "head_count": head_count,
+        "head_count_kv": metadata.get(f"{arch}.attention.head_count_kv", head_count),
+        "chat_template": metadata.get("tokenizer.chat_template"),
+        "file_type": file_type,
+        "quant": FILE_TYPES.get(file_type, str(file_type) if file_type is not None else None),
+        "parameters": parameters,
+    }
+
+
+def model_index(model_dir):
+    """
+    Returns {filename: entry} for every .gguf in model_dir, where entry holds the
+    file's size, mtime and header info. Headers are only read for
+    files that are new or changed since the last scan; the rest come from the index file.
+    """
+    index_path = os.path.join(model_dir, INDEX_FILE)
+    try:
+        with open(index_path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = {}
+
+    index = {}
+    changed = False
+    for name in sorted(os.listdir(model_dir)):
+        if not name.endswith(".gguf"):
+            continue
+        stat = os.stat(os.path.join(model_dir, name))
+        entry = cached.get(name)
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            index[name] = entry
+            continue
+        try:
+            info = read_gguf_info(os.path.join(model_dir, name))
+        except (OSError, ValueError, struct.error) as e:
+            info = {"error": str(e)}
+        index[name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "info": info}
+        changed = True
+
+    if changed or len(index) != len(cached):
+        # Write a new file and swap it in, so an interrupted write can't leave a truncated index
+        tmp_path = f"{index_path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, index_path)
+        except OSError:
+            pass
+    return index
+
+
+def model_info(model_path):
+    """
+    Returns the header info of one model file, going through its folder's index.
+    """
+    model_dir = os.path.dirname(model_path) or "."
+    entry = model_index(model_dir).get(os.path.basename(model_path))
+    return entry["info"] if entry else {}
+
+
+def format_parameters(parameters):
+    if not parameters:
+        return "?"
+    if parameters >= 1e9:
+        return f"{parameters / 1e9:.1f}B"
+    return f"{parameters / 1e6:.0f}M"
+
+
+def describe(entry):
+    """
+    Returns a one line summary of an index entry for the model picker.
+    """
+    info = entry["info"]
+    size = f"{entry['size'] / 1024 ** 3:.1f} GB"
+    if "error" in info:
+        return f"{size}, unreadable header"
+    parts = [size, info.get("architecture") or "?", format_parameters(info.get("parameters")),
+             info.get("quant") or "?"]
+    if info.get("context_length"):
+        parts.append(f"ctx {info['context_length']}")
+    return ", ".join(parts)
+
+
+def kv_cache_bytes(info, n_ctx, bytes_per_value=2):
+    """
+    Estimates the KV cache size for n_ctx tokens (f16 by default), or None if unknown.
+    """
+    try:
+        head_dim = info["embedding_length"] // info["head_count"]
+        return 2 * info["block_count"] * n_ctx * info["head_count_kv"] * head_dim * bytes_per_value
+    except (KeyError, TypeError, ZeroDivisionError):
+        return None
+
+
+def guess_chat_format(info):
+    """
+    Returns "llama-3" for models using the llama-3 template (or with no template at all,
+    keeping the old default), and None to let llama-cpp-python use the file's own template.
+    """
+    template = info.get("chat_template")
+    if not template or "<|start_header_id|>" in template:
+        return "llama-3"
+    return None
@@ -0,0 +1,145 @@
+import hashlib
+from bisect import bisect_left
+
+
+class TokenCache:
+    """Token counts keyed by a hash of the text, so each text is tokenized once."""
+    def __init__(self, count_tokens):
+        self.count_tokens = count_tokens
+        self.counts = {}
+
+    def count(self, text):
+        """
+        Returns the token count of text, tokenizing it only on a cache miss.
+        """
+        if not text:
+            return 0
+        key = hashlib.blake2b(text.encode('utf-8', errors='ignore'), digest_size=16).digest()
+        tokens = self.counts.get(key)
+        if tokens is None:
+            tokens = self.counts[key] = self.count_tokens(text)
+        return tokens
+
+    def message_tokens(self, message):
+        """
+        Returns the token count of a message, caching it on the message itself.
+        """
+        tokens = message.get("tokens")
+        if tokens is None:
+            tokens = message["tokens"] = self.count(message.get("content", ""))
+        return tokens
+
+    def clear(self):
+        """
+        Forgets all cached counts, e.g. after switching to a model with a different tokenizer.
+        """
+        self.counts.clear()
+
+
+class ChatHistory:
+    """
+    The conversation with a running prefix sum of per-message token counts.
+    The first `pinned` messages (the system prompt, plus the summary of compacted
+    turns if there is one) are always kept when windowing.
+    Changes are recorded to `journal` (a SessionJournal) when one is attached.
+    """
+    def __init__(self, token_cache, messages=None):
+        self.token_cache = token_cache
+        self.messages = []
+        self.prefix = [0]
+        self.pinned = 1
+        self.journal = None
+        for message in messages or []:
+            self.append(message)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    @property
+    def total_tokens(self):
+        return self.prefix[-1]
+
+    def append(self, message):
+        self.messages.append(message)
+        self.prefix.append(self.prefix[-1] + self.token_cache.message_tokens(message))
+        if self.journal:
+            self.journal.record("append", message=message)
+
+    def pop(self, count=1):
+        """
+        Removes the last count messages.
+        """
+        count = min(count, len(self.messages))
+        if count:
+            del self.messages[-count:]
+            del self.prefix[-count:]
+            self.pinned = max(1, min(self.pinned, len(self.messages)))
+            if self.journal:
+                self.journal.record("pop", count=count)
+
+    def clear(self):
+        self.messages = []
+        self.prefix = [0]
+        self.pinned = 1
+        if self.journal:
+            self.journal.record("clear")
+
+    def reset(self, messages):
+        """
+        Replaces the whole conversation, e.g. when a new character card is loaded.
+        """
+        journal, self.journal = self.journal, None
+        self.clear()
+        for message in messages:
+            self.append(message)
+        self.journal = journal
+        if journal:
+            journal.record("reset", messages=self.messages)
+
+    def recount(self):
+        """
+        Drops cached counts and rebuilds the prefix sum with the current tokenizer.
+        """
+        self.token_cache.clear()
+        messages, pinned, journal = self.messages, self.pinned, self.journal
+        for message in messages:
+            message.pop("tokens", None)
+        # Same conversation, so nothing for the journal
+        self.journal = None
+        self.reset(messages)
+        self.pinned, self.journal = pinned, journal
+
+    def compact(self, end, summary):
+        """
+        Replaces messages[1:end] (older turns, including any previous summary) with
+        a summary message that is kept from then on like the first message.
+        """
+        messages = [self.messages[0], summary] + self.messages[end:]
+        journal, self.journal = self.journal, None
+        self.reset(messages)
+        self.pinned, self.journal = 2, journal
+        if journal:
+            journal.record("compact", end=end, summary=summary)
+
+    def window(self, max_tokens):
+        """
+        Returns the pinned messages plus the most recent messages that fit within max_tokens.
+        The cut point is found by binary search over the prefix sum, so the cost does
+        not grow with the length of the history.
+        """
+        pinned = self.pinned
+        if len(self.messages) <= pinned + 1:  # System (and summary) + user message
+            return list(self.messages)
+
+        # Leave some buffer on top of the pinned messages
+        available_tokens = max_tokens - self.prefix[pinned] - 100
+
+        # Earliest start whose suffix (start .. end) fits in the available tokens
+        start = bisect_left(self.prefix, self.prefix[-1] - available_tokens, pinned, len(self.messages))
+        return self.messages[:pinned] + self.messages[start:]
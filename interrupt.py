@@ -0,0 +1,71 @@
+import os
+import sys
+import tty
+import select
+import termios
+import threading
+
+
+class AbortSwitch:
+    """
+    Lets llama.cpp abort a decode in progress, including prompt processing,
+    whenever `event` is set.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self._callback = None
+
+    def install(self, llm):
+        """
+        Attaches the switch to a model's context. Must be called again after a model reload.
+        """
+        from llama_cpp import llama_cpp
+        if self._callback is None:
+            # Keep a reference to the ctypes callback so it is not garbage collected
+            self._callback = llama_cpp.ggml_abort_callback(lambda _data: self.event.is_set())
+        llama_cpp.llama_set_abort_callback(llm._ctx.ctx, self._callback, None)
+
+    def stopping_criteria(self, input_ids, logits):
+        """
+        llama-cpp-python stopping criteria that ends generation once the switch is set.
+        """
+        return self.event.is_set()
+
+
+class InterruptListener:
+    """
+    A context manager that puts the terminal in cbreak mode and watches stdin on a
+    background thread, flipping the abort switch as soon as any key is pressed.
+    On exit, keystrokes typed during generation are discarded so they don't leak
+    into the next input().
+    """
+    def __init__(self, switch, poll_interval=0.05):
+        self.switch = switch
+        self.poll_interval = poll_interval
+        self.interrupted = False
+
+    def __enter__(self):
+        self.fd = sys.stdin.fileno()
+        self.old_settings = termios.tcgetattr(self.fd)
+        tty.setcbreak(self.fd)
+        self.switch.event.clear()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._watch, daemon=True)
+        self.thread.start()
+        return self
+
+    def _watch(self):
+        while not self.stopping.is_set():
+            ready, _, _ = select.select([self.fd], [], [], self.poll_interval)
+            if ready:
+                os.read(self.fd, 1024)
+                self.switch.event.set()
+                return
+
+    def __exit__(self, type, value, traceback):
+        self.stopping.set()
+        self.thread.join()
+        self.interrupted = self.switch.event.is_set()
+        self.switch.event.clear()
+        termios.tcflush(self.fd, termios.TCIFLUSH)
+        termios.tcsetattr(self.fd, termios.TCSADRAIN, self.old_settings)
@@ -0,0 +1,203 @@
+import os
+import re
+import glob
+import json
+import mmap
+import time
+import uuid
+import pickle
+import threading
+
+from snapshots import save_state
+
+CHECKPOINTS_KEPT = 2
+
+
+def journal_path(journal_dir, user_name, card_path=None):
+    """
+    Returns a new journal file for a session of a user with a card (or plain chat
+    without a card). Every session gets its own file, so none replaces another.
+    """
+    card = os.path.splitext(os.path.basename(card_path))[0] if card_path else "chat"
+    slug = re.sub(r"[^\w.-]+", "_", f"{user_name}-{card}").strip("_")
+    return os.path.join(journal_dir, f"{slug}-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}.jsonl")
+
+
+class SessionJournal:
+    """
+    An append-only log of everything that changes a conversation, one JSON object
+    per line. Lines are flushed as they are written, so a crash of the app loses
+    nothing; fsync (protection against power loss) is batched to every
+    sync_every entries or sync_interval seconds. Every few replies the model's
+    KV state is written next to the journal as a checkpoint, so a resumed session
+    doesn't need its history evaluated again.
+    """
+    def __init__(self, path, sync_every=8, sync_interval=2.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.last_sync = time.monotonic()
+        self.checkpoints = sorted(glob.glob(f"{glob.escape(path)}.*.state"), key=checkpoint_number)
+        self.file = open(path, 'a', encoding='utf-8')
+
+    @classmethod
+    def create(cls, journal_dir, user_name, card_path, model_path, messages):
+        """
+        Starts a journal in a new file for a session of user_name with card_path.
+        """
+        os.makedirs(journal_dir, exist_ok=True)
+        path = journal_path(journal_dir, user_name, card_path)
+        # 'x' never opens an existing journal
+        open(path, 'x').close()
+        journal = cls(path)
+        journal.record("start", user=user_name, card=card_path, model=model_path and os.path.abspath(model_path),
+                       time=time.time())
+        journal.record("reset", messages=list(messages))
+        return journal
+
+    def record(self, op, **fields):
+        """
+        Appends one entry. ChatHistory calls this for append, pop, clear, reset and compact.
+        """
+        line = json.dumps({"op": op, **fields}, ensure_ascii=False)
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(line + "\n")
+            self.file.flush()
+            self.pending += 1
+            if self.pending >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def sync(self):
+        with self.lock:
+            if self.pending and not self.file.closed:
+                self._sync()
+
+    def checkpoint(self, llm, message_count):
+        """
+        Saves the model's KV state for the first message_count messages on a
+        background thread, then records it in the journal. Older checkpoint files
+        are removed.
+        """
+        state = save_state(llm)
+        number = checkpoint_number(self.checkpoints[-1]) + 1 if self.checkpoints else 1
+        path = f"{self.path}.{number}.state"
+        self.checkpoints.append(path)
+        model = os.path.abspath(llm.model_path)
+        n_ctx = llm.n_ctx()
+
+        def write():
+            try:
+                with open(f"{path}.tmp", 'wb') as f:
+                    pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(f"{path}.tmp", path)
+            except OSError as e:
+                print(f"Failed to write session checkpoint: {e}")
+                return
+            if self.file.closed:
+                # The session was closed meanwhile; its journal takes no more entries
+                os.remove(path)
+                return
+            self.record("checkpoint", file=os.path.basename(path), messages=message_count, model=model, n_ctx=n_ctx)
+            self.sync()
+            for old in self.checkpoints[:-CHECKPOINTS_KEPT]:
+                if old != path and os.path.exists(old):
+                    os.remove(old)
+
+        threading.Thread(target=write).start()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self._sync()
+                self.file.close()
+
+
+def checkpoint_number(path):
+    try:
+        return int(path.rsplit(".", 2)[-2])
+    except (ValueError, IndexError):
+        return 0
+
+
+def replay(path):
+    """
+    Rebuilds a session from its journal. Returns a dict with the user, card, model,
+    messages, pinned count and the latest checkpoint entry (or None). A torn last
+    line from a crash is ignored.
+    """
+    session = {"user": None, "card": None, "model": None, "messages": [], "pinned": 1, "checkpoint": None}
+    messages = session["messages"]
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return session
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            for line in iter(buf.readline, b""):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                op = entry.get("op")
+                if op == "start":
+                    session.update(user=entry.get("user"), card=entry.get("card"), model=entry.get("model"))
+                elif op == "append":
+                    messages.append(entry["message"])
+                elif op == "pop":
+                    del messages[max(0, len(messages) - entry["count"]):]
+                    session["pinned"] = max(1, min(session["pinned"], len(messages)))
+                elif op in ("reset", "clear"):
+                    messages[:] = entry.get("messages", [])
+                    session["pinned"] = 1
+                elif op == "compact":
+                    messages[:] = [messages[0], entry["summary"]] + messages[entry["end"]:]
+                    session["pinned"] = 2
+                elif op == "checkpoint":
+                    session["checkpoint"] = entry
+    return session
+
+
+def load_checkpoint(journal_file, checkpoint, llm):
+    """
+    Loads a checkpoint's KV state into llm if it was saved with the same model and
+    n_ctx. Returns True on success.
+    """
+    if not checkpoint:
+        return False
+    if checkpoint.get("model") != os.path.abspath(llm.model_path) or checkpoint.get("n_ctx") != llm.n_ctx():
+        return False
+    path = os.path.join(os.path.dirname(journal_file), checkpoint["file"])
+    try:
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+    except Exception:
+        return False
+    llm.load_state(state)
+    return True
+
+
+def list_journals(journal_dir, user_name=None):
+    """
+    Returns [(path, session header)] for the journals in journal_dir, newest first,
+    optionally only those of user_name.
+    """
+    journals = []
+    for path in glob.glob(os.path.join(journal_dir, "*.jsonl")):
+        try:
+            with open(path, encoding='utf-8') as f:
+                header = json.loads(f.readline())
+        except (OSError, ValueError):
+            continue
+        if user_name and header.get("user") != user_name:
+            continue
+        journals.append((os.path.getmtime(path), path, header))
+    return [(path, header) for _, path, header in sorted(journals, reverse=True)]
@@ -0,0 +1,123 @@
+import json
+import time
+from collections import deque
+
+from prewarm import common_prefix_length
+
+# Fields shown by /stats: (key, label, format)
+SUMMARY_FIELDS = (
+    ("ttft_ms", "time to first token", "{:.0f} ms"),
+    ("prompt_eval_ms", "prompt eval", "{:.0f} ms"),
+    ("prompt_evaluated", "prompt tokens evaluated", "{:.0f}"),
+    ("prompt_reused", "prompt tokens reused", "{:.0f}"),
+    ("decode_tps", "decode speed", "{:.1f} tok/s"),
+    ("truncation_ms", "truncation", "{:.2f} ms"),
+    ("render_ms", "render", "{:.2f} ms"),
+)
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class TurnMetrics:
+    """
+    Measures one reply: call the methods at each point of the turn, then take record().
+    Token counts come from the model's own position (n_tokens), so they count
+    tokens rather than stream chunks, and decode speed excludes prompt eval.
+    """
+    def __init__(self, llm):
+        self.llm = llm
+        self.start = time.perf_counter()
+        self.generation_start = self.start
+        self.cached_ids = list(llm._input_ids)
+        self.truncation = 0.0
+        self.render = 0.0
+        self.first_token = None
+        self.prompt_tokens = 0
+        self.reused = 0
+
+    def begin_generation(self):
+        """Marks the moment the prompt is handed to the model."""
+        self.generation_start = time.perf_counter()
+
+    def on_first_token(self):
+        self.first_token = time.perf_counter()
+        self.prompt_tokens = self.llm.n_tokens
+        # llama.cpp re-evaluates at least the last prompt token, like Llama.generate
+        self.reused = min(common_prefix_length(self.cached_ids, self.llm._input_ids), max(0, self.prompt_tokens - 1))
+
+    def tokens_so_far(self):
+        return max(1, self.llm.n_tokens - self.prompt_tokens + 1) if self.first_token else 0
+
+    def decode_tps(self, now=None):
+        if not self.first_token:
+            return 0.0
+        seconds = (now or time.perf_counter()) - self.first_token
+        # The first token is produced by prompt eval, so it doesn't count toward decode speed
+        return (self.tokens_so_far() - 1) / seconds if seconds > 0 else 0.0
+
+    def record(self, interrupted=False, draft_stats=None):
+        """
+        Returns the turn's metrics as a dict.
+        """
+        end = time.perf_counter()
+        record = {
+            "time": time.time(),
+            "model": getattr(self.llm, "model_path", None),
+            "n_ctx": self.llm.n_ctx(),
+            "n_batch": self.llm.n_batch,
+            "prompt_tokens": self.prompt_tokens,
+            "prompt_reused": self.reused,
+            "prompt_evaluated": self.prompt_tokens - self.reused,
+            "generated_tokens": self.tokens_so_far(),
+            # As the user sees it, including the app's own work before generation starts
+            "ttft_ms": (self.first_token - self.start) * 1000 if self.first_token else None,
+            "prompt_eval_ms": (self.first_token - self.generation_start) * 1000 if self.first_token else None,
+            "decode_tps": self.decode_tps(end),
+            "truncation_ms": self.truncation * 1000,
+            "render_ms": self.render * 1000,
+            "turn_ms": (end - self.start) * 1000,
+            "interrupted": interrupted,
+        }
+        if draft_stats is not None:
+            record["draft_acceptance"] = draft_stats.acceptance_rate
+        return record
+
+
+class MetricsLog:
+    """
+    Keeps the metrics of the last `window` turns for /stats and appends every
+    turn to a JSONL file if a path is given.
+    """
+    def __init__(self, path=None, window=100):
+        self.path = path
+        self.turns = deque(maxlen=window)
+
+    def add(self, record):
+        self.turns.append(record)
+        if self.path:
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record) + "\n")
+            except OSError:
+                pass
+
+    def summary(self):
+        """
+        Returns /stats text: p50/p90/p99 of each metric over the recent turns.
+        """
+        if not self.turns:
+            return "No turns recorded yet."
+        lines = [f"Last {len(self.turns)} turns (p50 / p90 / p99):"]
+        for key, label, fmt in SUMMARY_FIELDS:
+            values = [t[key] for t in self.turns if t.get(key) is not None]
+            if not values:
+                continue
+            stats = " / ".join(fmt.format(percentile(values, q)) for q in (0.5, 0.9, 0.99))
+            lines.append(f"  {label:<24} {stats}")
+        last = self.turns[-1]
+        lines.append(f"  n_ctx {last['n_ctx']}, n_batch {last['n_batch']}"
+                     + (f", log: {self.path}" if self.path else ""))
+        return "\n".join(lines)
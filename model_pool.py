@@ -0,0 +1,75 @@
+import os
+import gc
+from collections import OrderedDict
+
+from gguf import kv_cache_bytes
+
+
+class ModelPool:
+    """
+    Keeps up to max_models loaded models (and, if set, at most max_bytes of them)
+    so switching back to one is instant. The least recently used model is closed
+    to make room for a new one.
+    Models are memory mapped, so several contexts of the same file share its
+    pages and a model reopened with another n_ctx loads from the page cache.
+    """
+    def __init__(self, open_model, max_models=1, max_bytes=None, kv_bytes_per_value=2):
+        self.open_model = open_model
+        self.max_models = max(1, max_models)
+        self.max_bytes = max_bytes
+        self.kv_bytes_per_value = kv_bytes_per_value
+        self.models = OrderedDict()  # (path, n_ctx) -> (llm, info)
+
+    def __len__(self):
+        return len(self.models)
+
+    @staticmethod
+    def key(model_path, n_ctx):
+        return os.path.abspath(model_path), n_ctx
+
+    def resident_bytes(self, extra=None):
+        """
+        Estimates the memory used by the pooled models (plus extra, a (key, info)
+        pair about to be added): each file once, plus each context's KV cache.
+        """
+        entries = [(key, info) for key, (_, info) in self.models.items()]
+        if extra:
+            entries.append(extra)
+        paths = {key[0] for key, _ in entries}
+        total = sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+        return total + sum(kv_cache_bytes(info, key[1], self.kv_bytes_per_value) or 0 for key, info in entries)
+
+    def get(self, model_path, n_ctx, info):
+        """
+        Returns (llm, reused): the pooled model for these settings, or a newly
+        opened one after evicting what doesn't fit anymore.
+        """
+        key = self.key(model_path, n_ctx)
+        if key in self.models:
+            self.models.move_to_end(key)
+            return self.models[key][0], True
+        while self.models and (len(self.models) >= self.max_models or
+                               (self.max_bytes and self.resident_bytes((key, info)) > self.max_bytes)):
+            self.evict(next(iter(self.models)))
+        llm = self.open_model(model_path, n_ctx, info)
+        self.models[key] = (llm, info)
+        return llm, False
+
+    def add(self, model_path, n_ctx, info, llm):
+        """
+        Adds a model that was opened elsewhere (e.g. by the background loader).
+        """
+        self.models[self.key(model_path, n_ctx)] = (llm, info)
+
+    def evict(self, key):
+        llm, _ = self.models.pop(key)
+        # Free the weights and KV cache now rather than whenever the last reference goes
+        close = getattr(llm, "close", None)
+        if close:
+            close()
+        del llm
+        gc.collect()
+
+    def clear(self):
+        for key in list(self.models):
+            self.evict(key)
@@ -0,0 +1,64 @@
+import threading
+
+
+def common_prefix_length(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def eval_prefix(llm, prefix_text, cancel):
+    """
+    Evaluates prefix_text into the KV cache in n_batch chunks, skipping the part
+    that is already cached. Returns False if cancel was set before it finished.
+    """
+    tokens = llm.tokenize(prefix_text.encode('utf-8', errors='ignore'), add_bos=True, special=True)
+    # Skip what is already in the KV cache, like Llama.generate's prefix match
+    n_past = common_prefix_length(llm._input_ids, tokens)
+    if n_past >= len(tokens):
+        return True
+    llm.n_tokens = n_past
+    for i in range(n_past, len(tokens), llm.n_batch):
+        if cancel.is_set():
+            return False
+        llm.eval(tokens[i:i + llm.n_batch])
+    return True
+
+
+class PrewarmWorker:
+    """
+    Evaluates an already known prompt prefix into the model's KV cache on a
+    background thread while the main thread waits for user input.
+    """
+    def __init__(self):
+        self.thread = None
+        self.cancel = None
+
+    def start(self, llm, prefix_text):
+        """
+        Starts evaluating prefix_text, cancelling any prewarm still in progress.
+        """
+        self.stop()
+        self.cancel = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(llm, prefix_text, self.cancel), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Cancels the prewarm and waits for the current batch to finish, after which
+        the model is safe to use from the calling thread again.
+        """
+        if self.thread:
+            self.cancel.set()
+            self.thread.join()
+            self.thread = None
+
+    def _run(self, llm, prefix_text, cancel):
+        try:
+            eval_prefix(llm, prefix_text, cancel)
+        except Exception:
+            # A failed prewarm only costs the prefill it was meant to save
+            pass
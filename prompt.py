@@ -0,0 +1,72 @@
+import hashlib
+
+# Mirrors llama-cpp-python's "llama-3" chat format so prompt text built here
+# tokenizes the same way as the prompts create_chat_completion renders
+LLAMA3_ROLES = {
+    "system": "<|start_header_id|>system<|end_header_id|>\n\n",
+    "user": "<|start_header_id|>user<|end_header_id|>\n\n",
+    "assistant": "<|start_header_id|>assistant<|end_header_id|>\n\n",
+}
+LLAMA3_SEP = "<|eot_id|>"
+
+
+def format_llama3_message(message):
+    role = LLAMA3_ROLES[message["role"]]
+    content = message.get("content")
+    # Empty messages render as a bare header, matching llama-cpp-python
+    return f"{role}{content}{LLAMA3_SEP}" if content else role
+
+
+def format_llama3(messages):
+    """
+    Returns the full prompt for messages, ending with the assistant header.
+    """
+    return "".join(format_llama3_message(m) for m in messages) + LLAMA3_ROLES["assistant"]
+
+
+def format_llama3_user_prefix(messages):
+    """
+    Returns the prompt text that is already known before the user types their next
+    message: the conversation so far followed by the user header.
+    """
+    return "".join(format_llama3_message(m) for m in messages) + LLAMA3_ROLES["user"]
+
+
+class PromptBuilder:
+    """
+    Builds llama-3 prompts as token sequences, one cached segment per message.
+    Each message is formatted and tokenized once, so a turn only tokenizes its new
+    messages, and a truncated window is just fewer segments. Special tokens split
+    the text at every message boundary, so the segments joined are the same tokens
+    as the whole prompt tokenized at once.
+    """
+    def __init__(self, llm):
+        self.llm = llm
+        self.segments = {}
+        self.bos = llm.tokenize(b"", add_bos=True, special=True)
+        self.assistant_header = self.tokenize(LLAMA3_ROLES["assistant"])
+        self.stop_tokens = {llm.token_eos(), *self.tokenize(LLAMA3_SEP)}
+
+    def tokenize(self, text):
+        return self.llm.tokenize(text.encode('utf-8', errors='ignore'), add_bos=False, special=True)
+
+    def segment(self, message):
+        """
+        Returns the tokens of one formatted message, tokenizing it only on a cache miss.
+        """
+        text = format_llama3_message(message)
+        key = hashlib.blake2b(text.encode('utf-8', errors='ignore'), digest_size=16).digest()
+        tokens = self.segments.get(key)
+        if tokens is None:
+            tokens = self.segments[key] = self.tokenize(text)
+        return tokens
+
+    def build(self, messages):
+        """
+        Returns the prompt tokens for messages, ending with the assistant header.
+        """
+        tokens = list(self.bos)
+        for message in messages:
+            tokens.extend(self.segment(message))
+        tokens.extend(self.assistant_header)
+        return tokens
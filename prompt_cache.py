@@ -0,0 +1,82 @@
+import os
+import glob
+import pickle
+import hashlib
+
+
+class PromptCache:
+    """
+    Evaluated prompt KV states stored on disk, keyed by model file, context size and prompt.
+    The least recently used states are evicted once the cache grows past max_bytes.
+    """
+    def __init__(self, cache_dir="cache", max_bytes=8 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, model_path, n_ctx, prompt):
+        """
+        Returns the cache key for a prompt evaluated by a model file with a given n_ctx.
+        The model file's size and mtime are included so a replaced file is not reused.
+        """
+        stat = os.stat(model_path)
+        h = hashlib.sha256()
+        h.update(f"{os.path.abspath(model_path)}|{stat.st_size}|{stat.st_mtime_ns}|{n_ctx}|".encode('utf-8'))
+        h.update(prompt.encode('utf-8', errors='ignore'))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.state")
+
+    def load(self, key):
+        """
+        Returns the cached LlamaState for key, or None on a miss.
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Discarding unreadable prompt cache entry: {e}")
+            os.remove(path)
+            return None
+        # Mark as recently used for LRU eviction
+        os.utime(path)
+        return state
+
+    def save(self, key, state):
+        """
+        Writes a LlamaState for key, then evicts old entries to stay under max_bytes.
+        """
+        path = self.path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Failed to write prompt cache entry: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, "*.state")):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,87 @@
+import sys
+import time
+
+from colorama import Fore, Style
+
+
+class StreamRenderer:
+    """
+    Renders streamed AI text, coloring *action* blocks yellow.
+    Text is coalesced into colored spans and written with one buffered write per frame,
+    at most max_fps frames a second, together with any pending console title update.
+    """
+    def __init__(self, show_asterisks=False, max_fps=30, out=None):
+        self.show_asterisks = show_asterisks
+        self.interval = 1.0 / max_fps if max_fps > 0 else 0
+        self.out = out or sys.stdout
+        self.in_yellow_block = False
+        self.color = None  # Color currently open in the output
+        self.parts = []
+        self.title = None
+        self.last_frame = 0.0
+
+    def _append(self, text, color):
+        if color != self.color:
+            if self.color:
+                self.parts.append(Style.RESET_ALL)
+            if color:
+                self.parts.append(color)
+            self.color = color
+        self.parts.append(text)
+
+    def feed(self, text):
+        """
+        Buffers text, toggling the yellow block on each asterisk.
+        """
+        for i, part in enumerate(text.split('*')):
+            if i:
+                self.in_yellow_block = not self.in_yellow_block
+                if self.show_asterisks:
+                    self._append('*', Fore.YELLOW)
+            if part:
+                self._append(part, Fore.YELLOW if self.in_yellow_block else None)
+
+    def due(self):
+        """
+        Returns True if enough time has passed since the last frame to draw another.
+        """
+        return time.monotonic() - self.last_frame >= self.interval
+
+    def set_title(self, title):
+        self.title = title
+
+    def flush(self):
+        """
+        Writes everything buffered so far in a single write.
+        """
+        if self.title is not None:
+            self.parts.append(f"\x1b]0;{self.title}\x07")
+            self.title = None
+        if self.parts:
+            try:
+                self.out.write("".join(self.parts))
+                self.out.flush()
+            except Exception:
+                pass
+            self.parts = []
+        self.last_frame = time.monotonic()
+
+    def finish(self):
+        """
+        Closes any open color span and flushes the final frame.
+        """
+        if self.color:
+            self.parts.append(Style.RESET_ALL)
+            self.color = None
+        self.flush()
+
+
+def colorize(text, show_asterisks=True):
+    """
+    Returns text with *action* blocks colored yellow, as a single string.
+    """
+    renderer = StreamRenderer(show_asterisks=show_asterisks)
+    renderer.feed(text)
+    if renderer.color:
+        renderer.parts.append(Style.RESET_ALL)
+    return "".join(renderer.parts)
@@ -98,7 +98,7 @@ fi
 # Run the application
 echo -e "${GREEN}Starting ShitChat...${NC}"
 echo "================================"
-"$VENV_PYTHON" "$SCRIPT_DIR/app.py"
+"$VENV_PYTHON" "$SCRIPT_DIR/app.py" "$@"
 
 # Keep terminal open if there was an error
 if [ $? -ne 0 ]; then
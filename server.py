@@ -0,0 +1,323 @@
+import os
+import json
+import time
+import uuid
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from history import ChatHistory
+from sillytavern import load_card, card_index
+from sessions import SessionManager, Scheduler
+
+# Generation parameters passed through from the request to create_chat_completion, with their types
+SAMPLING_PARAMS = {
+    "temperature": float, "top_p": float, "top_k": int, "min_p": float, "max_tokens": int, "stop": list,
+    "presence_penalty": float, "frequency_penalty": float, "repeat_penalty": float, "seed": int,
+}
+
+
+def check_param(name, value):
+    """
+    Raises ValueError unless value has the type create_chat_completion expects for name.
+    """
+    kind = SAMPLING_PARAMS[name]
+    if value is None and name in ("max_tokens", "seed", "stop"):
+        return
+    if kind is list:
+        if isinstance(value, str) or (isinstance(value, list) and all(isinstance(v, str) for v in value)):
+            return
+        raise ValueError(f"'{name}' must be a string or a list of strings.")
+    # bool is an int in Python, but not a number in JSON
+    if isinstance(value, bool) or not isinstance(value, (int, float) if kind is float else int):
+        raise ValueError(f"'{name}' must be {'a number' if kind is float else 'an integer'}.")
+
+
+def check_session_fields(body):
+    """
+    Raises ValueError unless the request's session_id, card and user are strings (or absent).
+    """
+    for key in ("session_id", "card", "user"):
+        if body.get(key) is not None and not isinstance(body[key], str):
+            raise ValueError(f"'{key}' must be a string.")
+
+
+class Job:
+    """A queued chat completion request. Output chunks are handed back through `chunks`."""
+    def __init__(self, session, messages, params, stream):
+        self.session = session
+        self.messages = messages
+        self.params = params
+        self.stream = stream
+        self.chunks = queue.Queue()
+        self.cancelled = threading.Event()
+
+
+class ChatServer:
+    """
+    Serves the chat engine over an OpenAI-compatible HTTP API.
+    Requests are scheduled round-robin between sessions and run one at a time on a
+    single worker thread, which swaps each session's KV state into the shared model.
+    """
+    def __init__(self, llm, token_cache, card_dir="cards", user_name="User",
+                 max_resident_bytes=2 * 1024 ** 3, swap_dir=None):
+        self.llm = llm
+        self.token_cache = token_cache
+        self.card_dir = card_dir
+        self.user_name = user_name
+        self.sessions = SessionManager(llm, token_cache, max_resident_bytes, swap_dir)
+        self.jobs = Scheduler()
+        self.worker = threading.Thread(target=self._work, daemon=True)
+        self.worker.start()
+
+    def card_path(self, card):
+        """
+        Resolves a card name (with or without .png) to a file in the cards folder.
+        """
+        name = os.path.basename(card)
+        if not name.lower().endswith(".png"):
+            name += ".png"
+        path = os.path.join(self.card_dir, name)
+        if not os.path.exists(path):
+            raise ValueError(f"Unknown card: {card}")
+        return path
+
+    def list_cards(self):
+        """
+        Returns the usable cards as OpenAI-style list items with their name and description.
+        """
+        if not os.path.exists(self.card_dir):
+            return []
+        return [{"id": f[:-4], "object": "card", "name": e.get("name"), "description": e.get("description", "")}
+                for f, e in card_index(self.card_dir).items() if "error" not in e]
+
+    def get_session(self, session_id=None, card=None, user_name=None):
+        """
+        Returns the session for session_id, creating it when it doesn't exist yet.
+        A card starts the session with that character's system prompt; an existing
+        session is only started over when the card differs from the one it uses.
+        """
+        session = self.sessions.get(session_id) if session_id else None
+        if session is not None and not card:
+            return session
+        if not card:
+            return self.sessions.create(session_id)
+        path = self.card_path(card)
+        if session is not None and session.card_path == path:
+            return session
+        character, system_prompt = load_card(path, user_name or self.user_name)
+        if not character:
+            raise ValueError(f"Could not load card: {card}")
+        return self.sessions.create(session_id, system_prompt, character, path)
+
+    def submit(self, body):
+        """
+        Queues a chat completion request and returns its Job.
+        With a session_id (or card) the messages are appended to that session's
+        history; otherwise the request is stateless, like the OpenAI API.
+        """
+        messages = body.get("messages") or []
+        if not isinstance(messages, list):
+            raise ValueError("'messages' must be a list.")
+        for message in messages:
+            if not isinstance(message, dict):
+                raise ValueError("Each message must be an object.")
+            if message.get("role") not in ("system", "user", "assistant"):
+                raise ValueError(f"Unsupported message role: {message.get('role')}")
+            if not isinstance(message.get("content") or "", str):
+                raise ValueError("Message content must be a string.")
+        check_session_fields(body)
+        params = {k: body[k] for k in SAMPLING_PARAMS if k in body}
+        for name, value in params.items():
+            check_param(name, value)
+        session = None
+        if body.get("session_id") or body.get("card"):
+            session = self.get_session(body.get("session_id"), body.get("card"), body.get("user"))
+        job = Job(session, [{"role": m["role"], "content": m.get("content") or ""} for m in messages],
+                  params, bool(body.get("stream")))
+        # Stateless requests each get their own turn in the rotation
+        self.jobs.put(session.session_id if session else uuid.uuid4().hex, job)
+        return job
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                self._run(job)
+            except Exception as e:
+                job.chunks.put({"error": {"message": str(e), "type": type(e).__name__}})
+            finally:
+                job.chunks.put(None)
+
+    def _run(self, job):
+        if job.cancelled.is_set():
+            return
+        self.sessions.activate(job.session)
+        if job.session:
+            history = job.session.history
+            lorebook = job.session.lorebook
+            for message in job.messages:
+                if lorebook and message["role"] == "user":
+                    lore = lorebook.lore_message(history.window(self.llm.n_ctx() - 500), message["content"],
+                                                 self.token_cache.count)
+                    if lore:
+                        history.append(lore)
+                history.append(message)
+        else:
+            history = ChatHistory(self.token_cache, job.messages)
+
+        # Same truncation as the interactive chat loop
+        messages = history.window(self.llm.n_ctx() - 500)
+        stream = self.llm.create_chat_completion(messages=messages, stream=True, **job.params)
+        parts = []
+        for chunk in stream:
+            if job.cancelled.is_set():
+                break
+            text = chunk["choices"][0]["delta"].get("content")
+            if text:
+                parts.append(text)
+            job.chunks.put(chunk)
+        if job.session:
+            history.append({"role": "assistant", "content": "".join(parts)})
+
+
+def make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, obj, headers=None):
+            data = json.dumps(obj).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_error_json(self, status, message):
+            self.send_json(status, {"error": {"message": message, "type": "invalid_request_error"}})
+
+        def read_body(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def do_GET(self):
+            if self.path == "/v1/models":
+                model = os.path.basename(getattr(server.llm, "model_path", "model"))
+                self.send_json(200, {"object": "list", "data": [{"id": model, "object": "model"}]})
+            elif self.path == "/v1/cards":
+                self.send_json(200, {"object": "list", "data": server.list_cards()})
+            else:
+                self.send_error_json(404, f"Unknown endpoint: {self.path}")
+
+        def do_POST(self):
+            try:
+                body = self.read_body()
+            except ValueError:
+                self.send_error_json(400, "Request body is not valid JSON.")
+                return
+            if not isinstance(body, dict):
+                self.send_error_json(400, "Request body must be a JSON object.")
+                return
+            if self.path == "/v1/sessions":
+                try:
+                    check_session_fields(body)
+                    session = server.get_session(body.get("session_id"), body.get("card"), body.get("user"))
+                except ValueError as e:
+                    self.send_error_json(400, str(e))
+                    return
+                self.send_json(200, {"id": session.session_id, "object": "session",
+                                     "card": session.card_path, "messages": len(session.history)})
+            elif self.path == "/v1/chat/completions":
+                try:
+                    job = server.submit(body)
+                except ValueError as e:
+                    self.send_error_json(400, str(e))
+                    return
+                if job.stream:
+                    self.stream_job(job)
+                else:
+                    self.finish_job(job)
+            else:
+                self.send_error_json(404, f"Unknown endpoint: {self.path}")
+
+        def do_DELETE(self):
+            if self.path.startswith("/v1/sessions/"):
+                session_id = self.path[len("/v1/sessions/"):]
+                if server.sessions.close(session_id):
+                    self.send_json(200, {"id": session_id, "object": "session", "deleted": True})
+                else:
+                    self.send_error_json(404, f"Unknown session: {session_id}")
+            else:
+                self.send_error_json(404, f"Unknown endpoint: {self.path}")
+
+        def session_headers(self, job):
+            return {"X-Session-Id": job.session.session_id} if job.session else {}
+
+        def stream_job(self, job):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            for key, value in self.session_headers(job).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.close_connection = True
+            try:
+                while True:
+                    chunk = job.chunks.get()
+                    if chunk is None:
+                        break
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # Client went away; stop generating for it
+                job.cancelled.set()
+
+        def finish_job(self, job):
+            parts = []
+            finish_reason = None
+            first = None
+            while True:
+                chunk = job.chunks.get()
+                if chunk is None:
+                    break
+                if "error" in chunk:
+                    self.send_json(500, chunk)
+                    return
+                first = first or chunk
+                choice = chunk["choices"][0]
+                parts.append(choice["delta"].get("content") or "")
+                finish_reason = choice.get("finish_reason") or finish_reason
+            self.send_json(200, {
+                "id": first["id"] if first else f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": first["model"] if first else "",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(parts)},
+                             "finish_reason": finish_reason}],
+            }, self.session_headers(job))
+
+    return Handler
+
+
+def serve(llm, token_cache, host="127.0.0.1", port=8000, card_dir="cards", user_name="User",
+          max_resident_bytes=2 * 1024 ** 3, swap_dir=None):
+    """
+    Runs the OpenAI-compatible HTTP server until interrupted.
+    """
+    server = ChatServer(llm, token_cache, card_dir, user_name, max_resident_bytes, swap_dir)
+    httpd = ThreadingHTTPServer((host, port), make_handler(server))
+    print(f"Serving on http://{host}:{port}/v1/chat/completions (Ctrl+C to stop)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\nServer stopped.")
+    finally:
+        httpd.server_close()
@@ -0,0 +1,162 @@
+import os
+import time
+import uuid
+import pickle
+import threading
+from collections import OrderedDict, deque
+
+from history import ChatHistory
+from snapshots import state_size, save_state
+from sillytavern import load_lorebook
+
+
+class Session:
+    """A conversation: its history, the character card it uses and its saved KV state."""
+    def __init__(self, session_id, history, character=None, card_path=None):
+        self.session_id = session_id
+        self.history = history
+        self.character = character
+        self.card_path = card_path
+        self.lorebook = load_lorebook(character) if character else None
+        self.last_used = time.time()
+
+
+class SessionManager:
+    """
+    Owns the sessions sharing one model and swaps their KV states in and out of it.
+    The state of the session that was last active is saved when another session
+    takes the model; saved states are kept in RAM up to max_resident_bytes, and the
+    least recently used ones spill to swap_dir (or are dropped if there is none).
+    """
+    def __init__(self, llm, token_cache, max_resident_bytes=2 * 1024 ** 3, swap_dir=None):
+        self.llm = llm
+        self.token_cache = token_cache
+        self.max_resident_bytes = max_resident_bytes
+        self.swap_dir = swap_dir
+        if swap_dir:
+            os.makedirs(swap_dir, exist_ok=True)
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.resident = OrderedDict()  # session_id -> (state, size)
+        self.resident_bytes = 0
+        self.active_id = None
+
+    def get(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session:
+                session.last_used = time.time()
+            return session
+
+    def create(self, session_id=None, system_prompt=None, character=None, card_path=None):
+        """
+        Creates (or replaces) a session, optionally starting with a system prompt.
+        """
+        session_id = session_id or uuid.uuid4().hex
+        history = ChatHistory(self.token_cache)
+        if system_prompt:
+            history.append({"role": "system", "content": system_prompt})
+        session = Session(session_id, history, character, card_path)
+        with self.lock:
+            self.sessions[session_id] = session
+        self._drop_state(session_id)
+        return session
+
+    def close(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        self._drop_state(session_id)
+        return session is not None
+
+    def activate(self, session):
+        """
+        Makes session's KV state the model's current state. Must only be called from
+        the thread that runs generation. Passing None parks the current session's state
+        so a stateless request can use the model.
+        """
+        session_id = session.session_id if session else None
+        if session_id is not None and session_id == self.active_id:
+            return
+        if self.active_id is not None and self.active_id in self.sessions:
+            self._store(self.active_id, save_state(self.llm))
+        self.active_id = session_id
+        if session_id is not None:
+            state = self._take(session_id)
+            if state is not None:
+                self.llm.load_state(state)
+
+    def swap_path(self, session_id):
+        return os.path.join(self.swap_dir, f"{session_id}.state")
+
+    def _store(self, session_id, state):
+        size = state_size(state)
+        with self.lock:
+            self.resident[session_id] = (state, size)
+            self.resident_bytes += size
+            evicted = []
+            while self.resident_bytes > self.max_resident_bytes and self.resident:
+                old_id, (old_state, old_size) = self.resident.popitem(last=False)
+                self.resident_bytes -= old_size
+                evicted.append((old_id, old_state))
+        for old_id, old_state in evicted:
+            if self.swap_dir:
+                with open(self.swap_path(old_id), 'wb') as f:
+                    pickle.dump(old_state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _take(self, session_id):
+        with self.lock:
+            entry = self.resident.pop(session_id, None)
+            if entry:
+                self.resident_bytes -= entry[1]
+                return entry[0]
+        if self.swap_dir and os.path.exists(self.swap_path(session_id)):
+            path = self.swap_path(session_id)
+            try:
+                with open(path, 'rb') as f:
+                    return pickle.load(f)
+            finally:
+                os.remove(path)
+        return None
+
+    def _drop_state(self, session_id):
+        with self.lock:
+            entry = self.resident.pop(session_id, None)
+            if entry:
+                self.resident_bytes -= entry[1]
+            if self.active_id == session_id:
+                self.active_id = None
+        if self.swap_dir and os.path.exists(self.swap_path(session_id)):
+            os.remove(self.swap_path(session_id))
+
+
+class Scheduler:
+    """
+    A round-robin job queue: each key (session) with pending jobs gets one job run
+    in turn, so a busy session can't starve the others.
+    """
+    def __init__(self):
+        self.queues = {}
+        self.order = deque()
+        self.cond = threading.Condition()
+
+    def put(self, key, job):
+        with self.cond:
+            jobs = self.queues.get(key)
+            if jobs is None:
+                jobs = self.queues[key] = deque()
+                self.order.append(key)
+            jobs.append(job)
+            self.cond.notify()
+
+    def get(self):
+        with self.cond:
+            while not self.order:
+                self.cond.wait()
+            key = self.order.popleft()
+            jobs = self.queues[key]
+            job = jobs.popleft()
+            if jobs:
+                self.order.append(key)
+            else:
+                del self.queues[key]
+            return job
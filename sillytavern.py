@@ -2,33 +2,63 @@ import os
 import re
 import json
 import zlib
+import mmap
 import base64
 import struct
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+TEXT_CHUNKS = (b'tEXt', b'zTXt', b'iTXt')
+# V3 cards keep their data in a 'ccv3' chunk, usually next to a V2 'chara' chunk for older readers
+CARD_KEYWORDS = ('ccv3', 'chara')
+
+INDEX_FILE = ".index.json"
+
+
+def decode_text_chunk(chunk_type, chunk_data):
+    """
+    Returns (keyword, text bytes) of a PNG tEXt, zTXt or iTXt chunk.
+    """
+    keyword, _, rest = chunk_data.partition(b'\x00')
+    if chunk_type == b'zTXt':
+        # Compression method byte, then zlib data
+        return keyword, zlib.decompress(rest[1:])
+    if chunk_type == b'iTXt':
+        compressed, rest = rest[0], rest[2:]
+        _language, _, rest = rest.partition(b'\x00')
+        _translated, _, text = rest.partition(b'\x00')
+        return keyword, zlib.decompress(text) if compressed else text
+    return keyword, rest
+
 
 def extract_chara_metadata(png_path):
+    """
+    Returns the card JSON stored in a PNG, or None if it has none. The file is
+    memory mapped and image data chunks are skipped by offset without being read.
+    """
     with open(png_path, 'rb') as f:
-        if f.read(8) != b'\x89PNG\r\n\x1a\n':
+        if f.read(8) != PNG_SIGNATURE:
             raise ValueError("Not a valid PNG file.")
-        while True:
-            length_bytes = f.read(4)
-            if len(length_bytes) < 4:
-                break
-            length = struct.unpack(">I", length_bytes)[0]
-            chunk_type = f.read(4)
-            chunk_data = f.read(length)
-            f.read(4)
-            if chunk_type == b'tEXt':
-                keyword, _, text = chunk_data.partition(b'\x00')
-                if keyword.decode('utf-8') == 'chara':
-                    return base64.b64decode(text).decode('utf-8')
-            elif chunk_type == b'zTXt':
-                keyword, rest = chunk_data.split(b'\x00', 1)
-                if keyword.decode('utf-8') == 'chara':
-                    compression_method = rest[0]
-                    if compression_method == 0:
-                        compressed_text = rest[1:]
-                        decompressed = zlib.decompress(compressed_text)
-                        return base64.b64decode(decompressed).decode('utf-8')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            found = {}
+            pos = 8
+            while pos + 8 <= len(buf):
+                length, chunk_type = struct.unpack_from(">I4s", buf, pos)
+                if chunk_type == b'IEND':
+                    break
+                if chunk_type in TEXT_CHUNKS:
+                    keyword, text = decode_text_chunk(chunk_type, buf[pos + 8:pos + 8 + length])
+                    keyword = keyword.decode('latin-1')
+                    if keyword in CARD_KEYWORDS:
+                        found[keyword] = text
+                        if keyword == CARD_KEYWORDS[0]:
+                            break
+                pos += 12 + length  # length, type, data, CRC
+    for keyword in CARD_KEYWORDS:
+        if keyword in found:
+            return base64.b64decode(found[keyword]).decode('utf-8')
     return None
 
 def process_character_metadata(chara_json, user_name):
@@ -47,3 +77,292 @@ def process_character_metadata(chara_json, user_name):
     except json.JSONDecodeError as e:
         print(f"Error decoding character JSON: {e}")
     return None, None, None
+
+def build_system_prompt(chara_obj, talk_prompt, depth_prompt):
+    """
+    Builds the roleplay system prompt from a processed character object.
+    """
+    data_section = chara_obj.get('data', chara_obj)
+    # Lorebook entries are injected into the chat when their keywords come up (see Lorebook),
+    # except the constant ones, which are always part of the prompt
+    book = data_section.get('character_book')
+    if book:
+        data_section = {k: v for k, v in data_section.items() if k != 'character_book'}
+        constant = [e.get('content', '') for e in Lorebook(book).entries if e.get('constant')]
+        if constant:
+            data_section['lore'] = constant
+    modified_data_json_string = json.dumps(data_section)
+    return f"{talk_prompt}{depth_prompt}roleplay the following scene defined in the json. do not break from your character\\n{modified_data_json_string}"
+
+def load_card(card_path, user_name):
+    """
+    Reads a character card and returns the character object and its system prompt,
+    or (None, None) if the card can't be used.
+    """
+    chara_json = card_json(card_path)
+    if not chara_json:
+        print("No 'chara' metadata found in PNG.")
+        return None, None
+
+    chara_obj, talk_prompt, depth_prompt = process_character_metadata(chara_json, user_name)
+    if not chara_obj:
+        print("Failed to process character metadata.")
+        return None, None
+
+    return chara_obj, build_system_prompt(chara_obj, talk_prompt, depth_prompt)
+
+class KeywordIndex:
+    """
+    An Aho-Corasick automaton: finds which of many keywords occur in a text in a
+    single pass, however many keywords there are.
+    """
+    def __init__(self, keywords):
+        """
+        keywords is an iterable of (keyword, value) pairs; search() returns the values.
+        """
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for keyword, value in keywords:
+            if not keyword:
+                continue
+            state = 0
+            for ch in keyword:
+                next_state = self.goto[state].get(ch)
+                if next_state is None:
+                    next_state = self.goto[state][ch] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                state = next_state
+            self.out[state].append(value)
+
+        # Breadth first, so each state's failure link points to an already finished state
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(ch, 0)
+                self.out[next_state] = self.out[next_state] + self.out[self.fail[next_state]]
+
+    def search(self, text):
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            if self.out[state]:
+                found.update(self.out[state])
+        return found
+
+class Lorebook:
+    """
+    The entries of a card's character_book, indexed by keyword once when the card
+    is loaded. Entries are injected into the chat only when their keywords appear
+    in the latest messages, instead of being sent with every prompt.
+    """
+    def __init__(self, book):
+        self.scan_depth = book.get('scan_depth') or 2
+        self.token_budget = book.get('token_budget')
+        self.recursive = bool(book.get('recursive_scanning'))
+        entries = [e for e in book.get('entries') or [] if e.get('enabled', True) and e.get('content')]
+        self.entries = sorted(entries, key=lambda e: e.get('insertion_order', 0))
+        keywords = {False: [], True: []}
+        for i, entry in enumerate(self.entries):
+            if entry.get('constant'):
+                continue
+            case_sensitive = bool(entry.get('case_sensitive'))
+            for kind, keys in (("primary", entry.get('keys')), ("secondary", entry.get('secondary_keys'))):
+                for key in keys or []:
+                    keywords[case_sensitive].append((key if case_sensitive else key.lower(), (i, kind)))
+        self.index = KeywordIndex(keywords[False])
+        self.case_sensitive_index = KeywordIndex(keywords[True]) if keywords[True] else None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def match(self, text):
+        """
+        Returns the indexes of the entries triggered by text. Selective entries also
+        need one of their secondary keys.
+        """
+        hits = self.index.search(text.lower())
+        if self.case_sensitive_index:
+            hits |= self.case_sensitive_index.search(text)
+        triggered = set()
+        for i, kind in hits:
+            if kind == "primary" and (not self.entries[i].get('selective') or not self.entries[i].get('secondary_keys')
+                                      or (i, "secondary") in hits):
+                triggered.add(i)
+        return triggered
+
+    def lore_message(self, messages, text, count_tokens=None):
+        """
+        Returns a system message with the entries triggered by text and the last
+        scan_depth messages, leaving out entries already injected in messages.
+        Returns None if there is nothing new. The message is meant to be appended
+        to the history just before the user's message, so the prompt only ever
+        grows at the end and the cached prefix stays valid.
+        """
+        present = set()
+        for message in messages:
+            present.update(message.get('lore', ()))
+
+        scan = [m.get('content', '') for m in messages[-self.scan_depth:] if not m.get('lore')] + [text]
+        triggered = self.match("\n".join(scan))
+        if self.recursive:
+            # Entries can trigger other entries through their content
+            new = triggered
+            while new:
+                new = self.match("\n".join(self.entries[i]['content'] for i in new)) - triggered
+                triggered |= new
+
+        contents, ids, used = [], [], 0
+        for i in sorted(triggered - present):
+            content = self.entries[i]['content']
+            if self.token_budget and count_tokens:
+                used += count_tokens(content)
+                if used > self.token_budget:
+                    break
+            contents.append(content)
+            ids.append(i)
+        if not contents:
+            return None
+        return {"role": "system", "content": "\n\n".join(contents), "lore": ids}
+
+def load_lorebook(chara_obj):
+    """
+    Returns the Lorebook of a processed character object, or None if it has none.
+    """
+    book = chara_obj.get('data', chara_obj).get('character_book')
+    if not book or not book.get('entries'):
+        return None
+    return Lorebook(book)
+
+def card_summary(chara_json):
+    """
+    Returns the name and a one line description of a card for listings.
+    """
+    try:
+        chara_obj = json.loads(chara_json)
+    except json.JSONDecodeError:
+        return None, ""
+    data = chara_obj.get('data') or chara_obj
+    description = " ".join((data.get('description') or "").split())
+    if len(description) > 80:
+        description = description[:77] + "..."
+    return data.get('name'), description
+
+def index_card(card_path):
+    """
+    Returns the index entry of one card: its size, mtime and decoded JSON with a summary.
+    """
+    stat = os.stat(card_path)
+    entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    try:
+        chara_json = extract_chara_metadata(card_path)
+    except (OSError, ValueError, zlib.error, struct.error, UnicodeDecodeError) as e:
+        entry["error"] = str(e) or type(e).__name__
+        return entry
+    if not chara_json:
+        entry["error"] = "No 'chara' metadata found in PNG."
+        return entry
+    entry["name"], entry["description"] = card_summary(chara_json)
+    entry["json"] = chara_json
+    return entry
+
+def save_index(card_dir, index):
+    index_path = os.path.join(card_dir, INDEX_FILE)
+    tmp_path = f"{index_path}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+    except OSError:
+        pass
+
+def card_index(card_dir="cards", workers=8):
+    """
+    Returns {filename: entry} for every .png in card_dir. Cards are only decoded
+    when they are new or changed since the last scan (in a thread pool); the rest
+    come from the index file.
+    """
+    index_path = os.path.join(card_dir, INDEX_FILE)
+    try:
+        with open(index_path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = {}
+
+    index = {}
+    stale = []
+    for name in sorted(os.listdir(card_dir)):
+        if not name.lower().endswith(".png"):
+            continue
+        stat = os.stat(os.path.join(card_dir, name))
+        entry = cached.get(name)
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            index[name] = entry
+        else:
+            stale.append(name)
+
+    if stale:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            paths = [os.path.join(card_dir, name) for name in stale]
+            for name, entry in zip(stale, pool.map(index_card, paths)):
+                index[name] = entry
+        index = dict(sorted(index.items()))
+    if stale or len(index) != len(cached):
+        save_index(card_dir, index)
+    return index
+
+def card_json(card_path):
+    """
+    Returns the card JSON of a PNG, from its folder's index when it is up to date.
+    """
+    card_dir = os.path.dirname(card_path) or "."
+    name = os.path.basename(card_path)
+    try:
+        with open(os.path.join(card_dir, INDEX_FILE)) as f:
+            entry = json.load(f).get(name)
+        stat = os.stat(card_path)
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry.get("json")
+    except (OSError, ValueError):
+        pass
+    return extract_chara_metadata(card_path)
+
+def import_cards(src_dir, card_dir="cards", workers=8):
+    """
+    Copies every valid card in src_dir into card_dir, decoding them in a thread pool
+    and adding them to the index. Returns (imported, skipped) file names.
+    """
+    os.makedirs(card_dir, exist_ok=True)
+
+    def import_one(name):
+        entry = index_card(os.path.join(src_dir, name))
+        if "error" in entry:
+            return name, None
+        dest = os.path.join(card_dir, name)
+        shutil.copy2(os.path.join(src_dir, name), dest)
+        stat = os.stat(dest)
+        entry["size"], entry["mtime_ns"] = stat.st_size, stat.st_mtime_ns
+        return name, entry
+
+    names = sorted(n for n in os.listdir(src_dir) if n.lower().endswith(".png"))
+    index = card_index(card_dir, workers)
+    imported, skipped = [], []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for name, entry in pool.map(import_one, names):
+            if entry is None:
+                skipped.append(name)
+            else:
+                index[name] = entry
+                imported.append(name)
+    save_index(card_dir, dict(sorted(index.items())))
+    return imported, skipped
@@ -0,0 +1,88 @@
+import hashlib
+from collections import OrderedDict
+
+
+def fingerprint(messages):
+    """
+    Returns a stable key for a list of chat messages (roles and contents only).
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for message in messages:
+        h.update(message.get("role", "").encode('utf-8'))
+        h.update(b'\x00')
+        h.update(message.get("content", "").encode('utf-8', errors='ignore'))
+        h.update(b'\x01')
+    return h.hexdigest()
+
+
+def state_size(state):
+    """
+    Returns the approximate memory held by a LlamaState: the KV state plus its
+    numpy copies of the input ids and the logits (n_batch x n_vocab floats, or
+    one row per token with logits_all).
+    """
+    size = getattr(state, "llama_state_size", None)
+    if size is None:
+        size = len(getattr(state, "llama_state", b""))
+    for array in (getattr(state, "scores", None), getattr(state, "input_ids", None)):
+        size += getattr(array, "nbytes", 0)
+    return size
+
+
+def save_state(llm):
+    """
+    Returns llm.save_state() keeping only the last row of logits. A draft model
+    turns on logits_all, which makes the state copy n_tokens x n_vocab floats
+    (gigabytes for a long chat on a 128k vocabulary); nothing reads the older
+    rows, since generation re-evaluates the last prompt token after load_state,
+    and load_state broadcasts the one row back.
+    """
+    state = llm.save_state()
+    scores = getattr(state, "scores", None)
+    if scores is not None and len(scores) > 1:
+        state.scores = scores[-1:].copy()
+    return state
+
+
+class StateRing:
+    """
+    A bounded ring buffer of llama KV state snapshots keyed by prompt fingerprint.
+    The oldest snapshots are dropped once either the count or the memory cap is exceeded.
+    """
+    def __init__(self, max_states=8, max_bytes=1024 ** 3):
+        self.max_states = max_states
+        self.max_bytes = max_bytes
+        self.states = OrderedDict()
+        self.total_bytes = 0
+
+    def __len__(self):
+        return len(self.states)
+
+    def save(self, key, state):
+        """
+        Stores a snapshot, evicting the oldest ones to stay within the caps.
+        Returns False if the snapshot alone is larger than the memory cap.
+        """
+        size = state_size(state)
+        if size > self.max_bytes:
+            return False
+        self.discard(key)
+        self.states[key] = (state, size)
+        self.total_bytes += size
+        while len(self.states) > self.max_states or self.total_bytes > self.max_bytes:
+            _, (_, old_size) = self.states.popitem(last=False)
+            self.total_bytes -= old_size
+        return True
+
+    def get(self, key):
+        entry = self.states.get(key)
+        return entry[0] if entry else None
+
+    def discard(self, key):
+        entry = self.states.pop(key, None)
+        if entry:
+            self.total_bytes -= entry[1]
+
+    def clear(self):
+        self.states.clear()
+        self.total_bytes = 0
@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+
+from prewarm import common_prefix_length
+
+
+class DraftStats:
+    """
+    Wraps a llama-cpp-python draft model and counts how many of its drafted tokens
+    the main model accepted. A draft is scored on the next call, whose input holds
+    the tokens that were actually generated after it.
+    """
+    def __init__(self, draft_model):
+        self.draft_model = draft_model
+        self.reset()
+
+    def reset(self):
+        self.drafted = 0
+        self.accepted = 0
+        self.last_input = 0
+        self.last_draft = []
+
+    def __call__(self, input_ids, **kwargs):
+        ids = input_ids.tolist()
+        if self.last_draft and len(ids) > self.last_input:
+            self.accepted += common_prefix_length(self.last_draft, ids[self.last_input:])
+        draft = self.draft_model(input_ids, **kwargs)
+        self.last_input = len(ids)
+        self.last_draft = draft.tolist()
+        self.drafted += len(self.last_draft)
+        return draft
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted / self.drafted if self.drafted else 0.0
+
+    def summary(self):
+        return (f"speculative decoding: {self.accepted}/{self.drafted} drafted tokens accepted "
+                f"({self.acceptance_rate * 100:.1f}%)")
+
+
+class GGUFDraftModel:
+    """
+    Drafts tokens greedily with a small GGUF model that shares the main model's
+    vocabulary. Its KV cache follows the conversation, so each call only evaluates
+    the tokens that are new since the last one.
+    """
+    def __init__(self, model_path, n_ctx, num_pred_tokens=8, n_gpu_layers=-1):
+        from llama_cpp import Llama
+        self.llm = Llama(
+            model_path=model_path,
+            n_ctx=n_ctx,
+            n_batch=min(512, n_ctx),
+            n_gpu_layers=n_gpu_layers,
+            verbose=False,
+        )
+        self.num_pred_tokens = num_pred_tokens
+
+    def n_vocab(self):
+        return self.llm.n_vocab()
+
+    def last_logits(self):
+        """
+        Returns the logits of the last evaluated token. Llama.eval only copies them
+        to Llama.scores with logits_all, which the draft model doesn't need.
+        """
+        from llama_cpp import llama_cpp
+        logits = llama_cpp.llama_get_logits_ith(self.llm._ctx.ctx, -1)
+        return np.ctypeslib.as_array(logits, shape=(self.llm.n_vocab(),))
+
+    def __call__(self, input_ids, **kwargs):
+        ids = input_ids.tolist()
+        # Re-evaluate at least the last token to get fresh logits
+        n_past = min(common_prefix_length(self.llm._input_ids, ids), len(ids) - 1)
+        self.llm.n_tokens = n_past
+        self.llm.eval(ids[n_past:])
+        draft = []
+        eos = self.llm.token_eos()
+        for _ in range(self.num_pred_tokens):
+            if self.llm.n_tokens >= self.llm.n_ctx():
+                break
+            token = int(np.argmax(self.last_logits()))
+            if token == eos:
+                break
+            draft.append(token)
+            self.llm.eval([token])
+        return np.array(draft, dtype=np.intc)
+
+
+def make_draft_model(draft, n_ctx, num_pred_tokens, model_dir="models", n_gpu_layers=-1):
+    """
+    Returns the draft model for the --draft option: "lookup" for prompt lookup
+    decoding (n-grams from the conversation itself), or the path or file name of
+    a small GGUF model in model_dir, offloaded like the main model (n_gpu_layers).
+    """
+    if draft == "lookup":
+        from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+        return DraftStats(LlamaPromptLookupDecoding(num_pred_tokens=num_pred_tokens))
+    path = draft if os.path.exists(draft) else os.path.join(model_dir, draft)
+    return DraftStats(GGUFDraftModel(path, n_ctx, num_pred_tokens, n_gpu_layers))
@@ -0,0 +1,155 @@
+import ctypes
+import random
+
+from prewarm import common_prefix_length
+from prompt import format_llama3
+
+# Swipes are meant to differ, so they sample hotter than the chat's defaults
+SWIPE_SAMPLING = {"temperature": 0.8, "top_k": 40, "top_p": 0.95, "min_p": 0.05}
+
+
+class SwipeContext:
+    """
+    A second llama.cpp context on an already loaded model, with one KV sequence
+    per candidate reply. The main context stays untouched (it only has room for
+    one sequence); the evaluated conversation is copied over from it, so only
+    the part of the prompt it doesn't hold yet is evaluated here.
+    """
+    def __init__(self, llm, n_seq, n_ctx):
+        from llama_cpp import llama_cpp
+        from llama_cpp._internals import LlamaContext
+        self.llm = llm
+        self.n_seq = n_seq
+        params = llama_cpp.llama_context_params.from_buffer_copy(llm.context_params)
+        params.n_ctx = n_ctx
+        params.n_seq_max = n_seq
+        if hasattr(params, "kv_unified"):
+            # All sequences share one cache, so the copied prompt cells aren't duplicated
+            params.kv_unified = True
+        self.ctx = LlamaContext(model=llm._model, params=params, verbose=False)
+        self.batch = llama_cpp.llama_batch_init(max(llm.n_batch, n_seq), 0, n_seq)
+        self.vocab = llama_cpp.llama_model_get_vocab(llm._model.model)
+
+    def close(self):
+        from llama_cpp import llama_cpp
+        llama_cpp.llama_batch_free(self.batch)
+        self.ctx.close()
+
+    def decode(self, entries):
+        """
+        Decodes [(token, pos, seq_id, logits)] as one batch. Returns False if llama.cpp
+        failed or was aborted.
+        """
+        from llama_cpp import llama_cpp
+        batch = self.batch
+        for i, (token, pos, seq_id, logits) in enumerate(entries):
+            batch.token[i] = token
+            batch.pos[i] = pos
+            batch.n_seq_id[i] = 1
+            batch.seq_id[i][0] = seq_id
+            batch.logits[i] = logits
+        batch.n_tokens = len(entries)
+        return llama_cpp.llama_decode(self.ctx.ctx, batch) == 0
+
+    def copy_main_cache(self, tokens):
+        """
+        Copies the main context's KV cache into sequence 0 and drops what doesn't
+        match tokens. Returns how many tokens of tokens are now cached.
+        """
+        from llama_cpp import llama_cpp
+        llm = self.llm
+        # At least the last prompt token is evaluated here to get its logits
+        n_past = min(common_prefix_length(llm._input_ids, tokens), len(tokens) - 1)
+        if n_past <= 0:
+            return 0
+        size = llama_cpp.llama_state_seq_get_size(llm._ctx.ctx, 0)
+        buf = (ctypes.c_uint8 * size)()
+        written = llama_cpp.llama_state_seq_get_data(llm._ctx.ctx, buf, size, 0)
+        if not written or not llama_cpp.llama_state_seq_set_data(self.ctx.ctx, buf, written, 0):
+            self.ctx.kv_cache_clear()
+            return 0
+        self.ctx.kv_cache_seq_rm(0, n_past, -1)
+        return n_past
+
+    def make_sampler(self, seed, temperature, top_k, top_p, min_p):
+        from llama_cpp import llama_cpp
+        sampler = llama_cpp.llama_sampler_chain_init(llama_cpp.llama_sampler_chain_default_params())
+        llama_cpp.llama_sampler_chain_add(sampler, llama_cpp.llama_sampler_init_top_k(top_k))
+        llama_cpp.llama_sampler_chain_add(sampler, llama_cpp.llama_sampler_init_top_p(top_p, 1))
+        llama_cpp.llama_sampler_chain_add(sampler, llama_cpp.llama_sampler_init_min_p(min_p, 1))
+        llama_cpp.llama_sampler_chain_add(sampler, llama_cpp.llama_sampler_init_temp(temperature))
+        llama_cpp.llama_sampler_chain_add(sampler, llama_cpp.llama_sampler_init_dist(seed))
+        return sampler
+
+    def generate(self, tokens, max_tokens, cancel=None, temperature=0.8, top_k=40, top_p=0.95, min_p=0.05):
+        """
+        Evaluates the prompt once, shares it with every sequence, then decodes one
+        token of every unfinished candidate per batch. Returns a list of n_seq
+        token lists.
+        """
+        from llama_cpp import llama_cpp
+        n_past = self.copy_main_cache(tokens)
+        last = None
+        for i in range(n_past, len(tokens), self.llm.n_batch):
+            chunk = tokens[i:i + self.llm.n_batch]
+            entries = [(t, i + j, 0, i + j == len(tokens) - 1) for j, t in enumerate(chunk)]
+            if not self.decode(entries):
+                return [[] for _ in range(self.n_seq)]
+            last = len(entries) - 1
+        for seq_id in range(1, self.n_seq):
+            self.ctx.kv_cache_seq_cp(0, seq_id, -1, -1)
+
+        samplers = [self.make_sampler(random.getrandbits(32), temperature, top_k, top_p, min_p)
+                    for _ in range(self.n_seq)]
+        replies = [[] for _ in range(self.n_seq)]
+        try:
+            # Every candidate's first token comes from the shared prompt logits
+            indices = {seq_id: last for seq_id in range(self.n_seq)}
+            pos = len(tokens)
+            while indices and not (cancel and cancel.is_set()):
+                entries = []
+                for seq_id, index in indices.items():
+                    token = llama_cpp.llama_sampler_sample(samplers[seq_id], self.ctx.ctx, index)
+                    if llama_cpp.llama_vocab_is_eog(self.vocab, token):
+                        continue
+                    replies[seq_id].append(token)
+                    if len(replies[seq_id]) < max_tokens and pos < self.ctx.n_ctx():
+                        entries.append((token, pos, seq_id, True))
+                if not entries or not self.decode(entries):
+                    break
+                indices = {seq_id: i for i, (_, _, seq_id, _) in enumerate(entries)}
+                pos += 1
+        finally:
+            for sampler in samplers:
+                llama_cpp.llama_sampler_free(sampler)
+        return replies
+
+
+def generate_swipes(llm, messages, n, max_tokens=400, cancel=None, sampling=SWIPE_SAMPLING, builder=None):
+    """
+    Returns n alternative replies to messages (in the llama-3 format), decoded
+    together in one batch. The prompt comes from builder's cached token segments
+    when given. Models without a llama.cpp context (the fake model) fall back to
+    n separate completions.
+    """
+    if not hasattr(llm, "_ctx"):
+        replies = []
+        for _ in range(n):
+            if cancel and cancel.is_set():
+                break
+            result = llm.create_chat_completion(messages=messages, max_tokens=max_tokens, **sampling)
+            replies.append(result["choices"][0]["message"]["content"])
+        return replies
+
+    if builder:
+        tokens = builder.build(messages)
+    else:
+        tokens = llm.tokenize(format_llama3(messages).encode('utf-8', errors='ignore'), add_bos=True, special=True)
+    # Room for the cached conversation being copied over, plus every candidate's reply
+    n_ctx = max(llm.n_tokens, len(tokens)) + n * max_tokens
+    context = SwipeContext(llm, n, -(-n_ctx // 256) * 256)
+    try:
+        replies = context.generate(tokens, max_tokens, cancel, **sampling)
+    finally:
+        context.close()
+    return [llm.detokenize(reply).decode('utf-8', errors='ignore').strip() for reply in replies]
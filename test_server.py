@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from fakellm import FakeLlama
+from history import TokenCache
+from server import ChatServer
+
+
+@pytest.fixture
+def server():
+    llm = FakeLlama()
+    token_cache = TokenCache(lambda text: len(llm.tokenize(text.encode('utf-8'), add_bos=False)))
+    return ChatServer(llm, token_cache, card_dir=os.path.join(os.path.dirname(__file__), "cards"))
+
+
+def chat(server, body):
+    job = server.submit({"max_tokens": 4, **body})
+    while job.chunks.get(timeout=10) is not None:
+        pass
+    return job.session
+
+
+def test_same_card_continues_the_history(server):
+    session = chat(server, {"messages": [{"role": "user", "content": "hi"}], "card": "Zombie Outbreak"})
+    chat(server, {"messages": [{"role": "user", "content": "and then?"}], "card": "Zombie Outbreak",
+                  "session_id": session.session_id})
+    assert server.sessions.get(session.session_id) is session
+    # System prompt plus two exchanges
+    assert len(session.history) == 5
+
+
+def test_another_card_starts_the_session_over(server):
+    session = chat(server, {"messages": [{"role": "user", "content": "hi"}], "card": "Zombie Outbreak"})
+    cards = [card["id"] for card in server.list_cards() if card["id"] != "Zombie Outbreak"]
+    replaced = chat(server, {"messages": [{"role": "user", "content": "hello"}], "card": cards[0],
+                             "session_id": session.session_id})
+    assert replaced is not session
+    assert replaced.session_id == session.session_id
+    assert len(replaced.history) == 3
@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import pytest
+
+from speculative import GGUFDraftModel, DraftStats
+
+
+class FakeDraftLlama:
+    """Predicts (last token + 1) % n_vocab, with token 0 as end of stream."""
+    def __init__(self, n_vocab=50, n_ctx=64):
+        self._n_vocab = n_vocab
+        self._n_ctx = n_ctx
+        self.input_ids = []
+        self.n_tokens = 0
+        self.evaluated = 0
+
+    @property
+    def _input_ids(self):
+        return self.input_ids[:self.n_tokens]
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def n_vocab(self):
+        return self._n_vocab
+
+    def token_eos(self):
+        return 0
+
+    def eval(self, tokens):
+        self.input_ids = self.input_ids[:self.n_tokens] + list(tokens)
+        self.n_tokens = len(self.input_ids)
+        self.evaluated += len(tokens)
+
+
+class FakeDraftModel(GGUFDraftModel):
+    def __init__(self, llm, num_pred_tokens):
+        self.llm = llm
+        self.num_pred_tokens = num_pred_tokens
+
+    def last_logits(self):
+        logits = np.zeros(self.llm.n_vocab(), dtype=np.single)
+        logits[(self.llm._input_ids[-1] + 1) % self.llm.n_vocab()] = 1.0
+        return logits
+
+
+def test_drafts_follow_the_last_logits():
+    draft = FakeDraftModel(FakeDraftLlama(), num_pred_tokens=4)
+    assert draft(np.array([7, 3, 10], dtype=np.intc)).tolist() == [11, 12, 13, 14]
+
+
+def test_drafts_stop_at_end_of_stream():
+    draft = FakeDraftModel(FakeDraftLlama(n_vocab=50), num_pred_tokens=8)
+    assert draft(np.array([1, 47], dtype=np.intc)).tolist() == [48, 49]
+
+
+def test_only_new_tokens_are_evaluated():
+    llm = FakeDraftLlama()
+    draft = FakeDraftModel(llm, num_pred_tokens=2)
+    draft(np.array([1, 2, 3], dtype=np.intc))
+    llm.evaluated = 0
+    # The main model accepted the first drafted token and sampled its own after it
+    assert draft(np.array([1, 2, 3, 4, 9], dtype=np.intc)).tolist() == [10, 11]
+    assert llm.evaluated == 3
+
+
+def test_stats_count_accepted_tokens():
+    stats = DraftStats(FakeDraftModel(FakeDraftLlama(), num_pred_tokens=3))
+    stats(np.array([1, 2], dtype=np.intc))
+    stats(np.array([1, 2, 3, 4, 20], dtype=np.intc))
+    assert (stats.accepted, stats.drafted) == (2, 6)
+
+
+@pytest.mark.skipif(not os.environ.get("DRAFT_MODEL"), reason="set DRAFT_MODEL to a small .gguf file")
+def test_drafts_match_the_draft_models_greedy_predictions():
+    from llama_cpp import Llama
+    path = os.environ["DRAFT_MODEL"]
+    draft = GGUFDraftModel(path, n_ctx=512, num_pred_tokens=6, n_gpu_layers=0)
+    prompt = draft.llm.tokenize(b"The capital of France is Paris. The capital of Italy is")
+    drafted = draft(np.array(prompt, dtype=np.intc)).tolist()
+    assert drafted
+
+    reference = Llama(model_path=path, n_ctx=512, n_gpu_layers=0, logits_all=True, verbose=False)
+    reference.eval(prompt)
+    expected = []
+    for _ in drafted:
+        token = int(np.argmax(reference.scores[reference.n_tokens - 1]))
+        expected.append(token)
+        reference.eval([token])
+    assert drafted == expected
@@ -0,0 +1,251 @@
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import platform
+
+TUNE_FILE = ".tune.json"
+
+# ggml types llama.cpp accepts for the KV cache, and their size per value in bytes
+CACHE_TYPES = {"f32": 0, "f16": 1, "q4_0": 2, "q4_1": 3, "q5_0": 6, "q5_1": 7, "q8_0": 8}
+CACHE_TYPE_BYTES = {"f32": 4, "f16": 2, "q4_0": 18 / 32, "q4_1": 20 / 32, "q5_0": 22 / 32,
+                    "q5_1": 24 / 32, "q8_0": 34 / 32}
+
+# Batch sizes tried by autotune; n_ubatch is the part llama.cpp computes at once
+BATCH_SIZES = (256, 512, 1024, 2048)
+UBATCH_SIZES = (128, 256, 512)
+
+CALIBRATION_TEXT = (
+    "The rain had not stopped for three days, and the old lighthouse keeper watched the "
+    "harbour from the window, counting the boats that came back before nightfall. "
+)
+
+
+def parse_cpu_list(text):
+    """Parses a Linux cpulist such as '0-3,8-11' into a set of CPU numbers."""
+    cpus = set()
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        cpus.update(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def cpu_topology():
+    """
+    Returns (physical_cores, logical_cpus, numa_nodes) for the CPUs this process
+    may run on. numa_nodes is a list of CPU sets, one per node.
+    """
+    try:
+        allowed = os.sched_getaffinity(0)
+    except AttributeError:
+        allowed = set(range(os.cpu_count() or 1))
+
+    # Hyper-threads share a (physical id, core id) pair
+    cores = set()
+    try:
+        with open("/proc/cpuinfo") as f:
+            cpu = physical = None
+            for line in f:
+                key, _, value = line.partition(":")
+                key, value = key.strip(), value.strip()
+                if key == "processor":
+                    cpu, physical = int(value), "0"
+                elif key == "physical id":
+                    physical = value
+                elif key == "core id" and cpu in allowed:
+                    cores.add((physical, value))
+    except (OSError, ValueError):
+        pass
+    physical_cores = len(cores) or max(1, len(allowed) // 2)
+
+    nodes = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")):
+        try:
+            with open(path) as f:
+                node = parse_cpu_list(f.read()) & allowed
+        except (OSError, ValueError):
+            continue
+        if node:
+            nodes.append(node)
+    return physical_cores, len(allowed), nodes or [allowed]
+
+
+def host_key():
+    physical, logical, nodes = cpu_topology()
+    return f"{socket.gethostname()}|{platform.processor() or platform.machine()}|{physical}c{logical}t{len(nodes)}n"
+
+
+def tune_key(model_path, n_gpu_layers):
+    stat = os.stat(model_path)
+    return f"{os.path.basename(model_path)}|{stat.st_size}|{stat.st_mtime_ns}|gpu{n_gpu_layers}|{host_key()}"
+
+
+def tune_path(model_path):
+    return os.path.join(os.path.dirname(model_path) or ".", TUNE_FILE)
+
+
+def load_tuning(model_path, n_gpu_layers):
+    """
+    Returns the cached tuning for this model on this host, or None.
+    """
+    try:
+        with open(tune_path(model_path)) as f:
+            return json.load(f).get(tune_key(model_path, n_gpu_layers))
+    except (OSError, ValueError):
+        return None
+
+
+def save_tuning(model_path, n_gpu_layers, tuning):
+    path = tune_path(model_path)
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = {}
+    cached[tune_key(model_path, n_gpu_layers)] = tuning
+    try:
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(cached, f, indent=1)
+        os.replace(f"{path}.tmp", path)
+    except OSError:
+        pass
+
+
+def thread_candidates():
+    """
+    Returns (generation, prompt) thread counts to try. Generation is memory bound
+    and usually peaks at or below the physical core count (of one NUMA node);
+    prompt processing is compute bound and can also gain from hyper-threads.
+    """
+    physical, logical, nodes = cpu_topology()
+    node_cores = max(1, physical // len(nodes))
+    generation = {max(1, physical // 2), max(1, physical - 1), physical, node_cores}
+    prompt = {physical, logical, node_cores}
+    return sorted(generation), sorted(prompt)
+
+
+def set_threads(llm, n_threads, n_threads_batch):
+    from llama_cpp import llama_cpp
+    llama_cpp.llama_set_n_threads(llm._ctx.ctx, n_threads, n_threads_batch)
+    llm.n_threads, llm.n_threads_batch = n_threads, n_threads_batch
+
+
+def timed_eval(llm, tokens, chunk):
+    """
+    Evaluates tokens from an empty cache in chunks and returns the seconds it took.
+    """
+    llm.n_tokens = 0
+    start = time.perf_counter()
+    for i in range(0, len(tokens), chunk):
+        llm.eval(tokens[i:i + chunk])
+    return time.perf_counter() - start
+
+
+def timed_prefill(llm, tokens, n_batch, n_ubatch, n_threads_batch):
+    """
+    Evaluates tokens in a new context on llm's model with the given batch sizes
+    (which are fixed when a context is created) and returns the seconds it took.
+    """
+    from llama_cpp import llama_cpp
+    from llama_cpp._internals import LlamaContext, LlamaBatch
+    params = llama_cpp.llama_context_params.from_buffer_copy(llm.context_params)
+    params.n_ctx = -(-len(tokens) // 256) * 256
+    params.n_batch = n_batch
+    params.n_ubatch = n_ubatch
+    params.n_threads_batch = n_threads_batch
+    ctx = LlamaContext(model=llm._model, params=params, verbose=False)
+    batch = LlamaBatch(n_tokens=n_batch, embd=0, n_seq_max=1, verbose=False)
+    try:
+        start = time.perf_counter()
+        for i in range(0, len(tokens), n_batch):
+            batch.set_batch(tokens[i:i + n_batch], n_past=i, logits_all=False)
+            ctx.decode(batch)
+        return time.perf_counter() - start
+    finally:
+        batch.close()
+        ctx.close()
+
+
+def autotune(llm, decode_steps=16):
+    """
+    Runs a short prefill and decode calibration on a loaded model and returns the
+    fastest {n_threads, n_threads_batch, n_batch, n_ubatch}. The batch sizes are
+    timed in contexts of their own, so they can go above the loaded ones (which
+    only change when the model is loaded again). Leaves the model on the fastest
+    threads with an empty cache.
+    """
+    generation, prompt = thread_candidates()
+    batch_sizes = [size for size in BATCH_SIZES if size <= llm.n_ctx()] or [llm.n_batch]
+    # Longer than the largest batch, so that batch size is timed over more than one call
+    tokens = llm.tokenize((CALIBRATION_TEXT * (batch_sizes[-1] // 16)).encode('utf-8'), add_bos=True)
+    tokens = tokens[:batch_sizes[-1] + 256]
+    thread_tokens = tokens[:min(llm.n_batch, llm.n_ctx() - decode_steps - 1)]
+    current = (llm.n_threads, llm.n_threads_batch)
+
+    # Warm up (page in the weights) before timing anything
+    timed_eval(llm, tokens[:32], 32)
+
+    best_prompt, best_time = current[1], None
+    for n in prompt:
+        set_threads(llm, current[0], n)
+        seconds = timed_eval(llm, thread_tokens, llm.n_batch)
+        if best_time is None or seconds < best_time:
+            best_prompt, best_time = n, seconds
+
+    # The physical batch first, at the largest logical batch, then the logical batch
+    best_ubatch, best_time = None, None
+    for size in [size for size in UBATCH_SIZES if size <= batch_sizes[-1]] or batch_sizes[-1:]:
+        seconds = timed_prefill(llm, tokens, batch_sizes[-1], size, best_prompt)
+        if best_time is None or seconds < best_time:
+            best_ubatch, best_time = size, seconds
+    best_batch = batch_sizes[-1]
+    for size in batch_sizes[:-1]:
+        if size < best_ubatch:
+            continue
+        seconds = timed_prefill(llm, tokens, size, best_ubatch, best_prompt)
+        if seconds < best_time:
+            best_batch, best_time = size, seconds
+
+    best_generation, best_time = current[0], None
+    for n in generation:
+        set_threads(llm, n, best_prompt)
+        timed_eval(llm, tokens[:32], 32)
+        start = time.perf_counter()
+        for token in tokens[32:32 + decode_steps]:
+            llm.eval([token])
+        seconds = time.perf_counter() - start
+        if best_time is None or seconds < best_time:
+            best_generation, best_time = n, seconds
+
+    set_threads(llm, best_generation, best_prompt)
+    llm.reset()
+    return {"n_threads": best_generation, "n_threads_batch": best_prompt, "n_batch": best_batch,
+            "n_ubatch": best_ubatch, "decode_tps": round(decode_steps / best_time, 2)}
+
+
+def tune_model(llm, model_path, n_gpu_layers, report=None):
+    """
+    Applies the cached tuning for this model and host, calibrating (and caching)
+    it first if there is none. A new calibration is described through report
+    (default: printed to stderr). The batch sizes are applied as far as the loaded
+    context allows; load the model with the returned ones to get all of them.
+    """
+    tuning = load_tuning(model_path, n_gpu_layers)
+    if tuning:
+        set_threads(llm, tuning["n_threads"], tuning["n_threads_batch"])
+        llm.n_batch = min(tuning["n_batch"], llm.n_batch)
+        return tuning
+    tuning = autotune(llm)
+    llm.n_batch = min(tuning["n_batch"], llm.n_batch)
+    save_tuning(model_path, n_gpu_layers, tuning)
+    summary = (f"Autotune: {tuning['n_threads']} threads for generation, {tuning['n_threads_batch']} for prompts, "
+               f"batch {tuning['n_batch']}/{tuning['n_ubatch']} ({tuning['decode_tps']} tok/s).")
+    if report:
+        report(summary)
+    else:
+        print(summary, file=sys.stderr)
+    return tuning
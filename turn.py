@@ -0,0 +1,76 @@
+import time
+import contextlib
+
+from generation import GenerationStream
+from snapshots import fingerprint, state_size, save_state
+
+
+def stream_reply(llm, stream, messages, history, metrics, renderer, state_ring, token_cache,
+                 listener=None, cancel=None, save_prompt_state=None, draft_stats=None):
+    """
+    Plays one AI reply from its completion stream, the same way for the chat and
+    the benchmark: the model decodes on a GenerationStream while this thread draws
+    the text and the speed/context title (at most renderer's max_fps frames a
+    second), the prompt's KV state is kept in state_ring for /r and /g (and handed
+    to save_prompt_state if given), and the reply is appended to history.
+    listener is an optional context manager (e.g. InterruptListener) that is active
+    while generating; cancel is the event that interrupts the stream.
+    Returns (assistant_message, metrics record, size of a snapshot that didn't fit
+    state_ring or None).
+    """
+    # Each message is tokenized once and cached, so this is cheap after the first turn
+    base_total_tokens = sum(token_cache.message_tokens(m) for m in messages)
+    max_tokens = llm.n_ctx()
+    snapshot_key = fingerprint(messages)
+    snapshot_saved = state_ring.get(snapshot_key) is not None and not save_prompt_state
+    rejected_snapshot = []
+
+    def prompt_evaluated(text):
+        """Runs on the generation thread as the first text arrives, before decoding continues."""
+        metrics.on_first_token()
+        if not snapshot_saved:
+            # The prompt has just been evaluated; keep its KV state for /r and /g
+            state = save_state(llm)
+            if not state_ring.save(snapshot_key, state):
+                rejected_snapshot.append(state_size(state))
+            if save_prompt_state:
+                save_prompt_state(state)
+
+    def title(tokens_per_second, generated_tokens):
+        context_percent = (base_total_tokens + generated_tokens) / max_tokens * 100 if max_tokens > 0 else 0
+        return f"tps: {tokens_per_second:.2f} - ctx: {context_percent:.2f}%"
+
+    response_parts = []
+    # The model decodes on its own thread; this one only draws what it has produced so far
+    generation = GenerationStream(stream, on_first_text=prompt_evaluated)
+    with listener or contextlib.nullcontext():
+        generation.start()
+        try:
+            for text in generation:
+                render_start = time.perf_counter()
+                response_parts.append(text)
+                renderer.feed(text)
+
+                # Draw a frame (text and console title) at most max_fps times a second
+                if renderer.due():
+                    # Decode speed in tokens (not stream chunks), without the prompt eval time
+                    renderer.set_title(title(metrics.decode_tps(render_start), metrics.tokens_so_far()))
+                    renderer.flush()
+                metrics.render += time.perf_counter() - render_start
+
+        except RuntimeError:
+            # llama_decode fails when the abort switch stops prompt processing
+            if not (cancel and cancel.is_set()):
+                raise
+
+    render_start = time.perf_counter()
+    renderer.finish()
+    metrics.render += time.perf_counter() - render_start
+
+    assistant_message = {"role": "assistant", "content": "".join(response_parts)}
+    history.append(assistant_message)
+    record = metrics.record(getattr(listener, "interrupted", False), draft_stats)
+    # Only the new reply needs tokenizing, the rest of the ledger is cached
+    renderer.set_title(title(record["decode_tps"], token_cache.message_tokens(assistant_message)))
+    renderer.flush()
+    return assistant_message, record, rejected_snapshot[0] if rejected_snapshot else None